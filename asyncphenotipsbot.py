@@ -0,0 +1,232 @@
+# AsyncPhenoTipsBot
+# asyncio interface to the PhenoTipsBot framework
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from phenotipsbot import PhenoTipsBot
+
+class AsyncPhenoTipsBot:
+    MAX_IN_FLIGHT = 10 #requests
+
+    def __init__(self, base_url, username, password, ssl_verify=True, max_in_flight=MAX_IN_FLIGHT, index_path=None,
+                 metadata_cache=None, object_cache=None, mirror_path=None, record_type=dict, browsers=PhenoTipsBot.BROWSERS,
+                 reuse_editor=False):
+        #each in-flight request runs on its own worker thread with its own pooled connection
+        self.bot = PhenoTipsBot(base_url, username, password, ssl_verify, pool_size=max_in_flight, index_path=index_path,
+                                metadata_cache=metadata_cache, object_cache=object_cache, mirror_path=mirror_path,
+                                record_type=record_type, browsers=browsers, reuse_editor=reuse_editor)
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_in_flight)
+        self.phantom_semaphore = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def call(self, function, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(function, *args, **kwargs))
+
+    async def call_phantom(self, function, *args, **kwargs):
+        #pedigree operations beyond the number of browsers wait here instead of tying up worker threads
+        if not self.phantom_semaphore:
+            self.phantom_semaphore = asyncio.Semaphore(self.bot.browser_pool.size)
+        async with self.phantom_semaphore:
+            return await self.call(function, *args, **kwargs)
+
+    async def close(self):
+        await self.call(self.bot.close)
+        self.executor.shutdown()
+
+    async def create(self, patient_obj=None, study=None, owner=None, pedigree=None, journal=None, journal_key=None):
+        if pedigree:
+            return await self.call_phantom(self.bot.create, patient_obj, study, owner, pedigree, journal, journal_key)
+        return await self.call(self.bot.create, patient_obj, study, owner, None, journal, journal_key)
+
+    async def create_collaborator(self, patient_id, collaborator_obj):
+        return await self.call(self.bot.create_collaborator, patient_id, collaborator_obj)
+
+    async def create_object(self, patient_id, object_class, object_obj):
+        return await self.call(self.bot.create_object, patient_id, object_class, object_obj)
+
+    async def create_relative(self, patient_id, relative_obj):
+        return await self.call(self.bot.create_relative, patient_id, relative_obj)
+
+    async def create_vcf(self, patient_id, vcf_obj):
+        return await self.call(self.bot.create_vcf, patient_id, vcf_obj)
+
+    async def delete(self, patient_id):
+        await self.call(self.bot.delete, patient_id)
+
+    async def delete_collaborator(self, patient_id, collaborator_num):
+        await self.call(self.bot.delete_collaborator, patient_id, collaborator_num)
+
+    async def delete_file(self, patient_id, filename):
+        await self.call(self.bot.delete_file, patient_id, filename)
+
+    async def delete_object(self, patient_id, object_class, object_num):
+        await self.call(self.bot.delete_object, patient_id, object_class, object_num)
+
+    async def delete_relative(self, patient_id, relative_num):
+        await self.call(self.bot.delete_relative, patient_id, relative_num)
+
+    async def delete_vcf(self, patient_id, vcf_num):
+        await self.call(self.bot.delete_vcf, patient_id, vcf_num)
+
+    async def download_file(self, patient_id, filename, outpath):
+        await self.call(self.bot.download_file, patient_id, filename, outpath)
+
+    async def export_pedigree_ped(self, patient_id, id_generation='external'):
+        return await self.call_phantom(self.bot.export_pedigree_ped, patient_id, id_generation)
+
+    async def get(self, patient_id):
+        return await self.call(self.bot.get, patient_id)
+
+    async def get_all_objects(self, patient_id, classes=None):
+        return await self.call(self.bot.get_all_objects, patient_id, classes)
+
+    async def get_bulk(self, patient_ids, object_class='PhenoTips.PatientClass', chunk_size=PhenoTipsBot.BULK_CHUNK_SIZE):
+        return await self.call(self.bot.get_bulk, patient_ids, object_class, chunk_size)
+
+    async def get_collaborator(self, patient_id, collaborator_num):
+        return await self.call(self.bot.get_collaborator, patient_id, collaborator_num)
+
+    async def get_file(self, patient_id, filename):
+        return await self.call(self.bot.get_file, patient_id, filename)
+
+    async def get_id(self, external_id):
+        return await self.call(self.bot.get_id, external_id)
+
+    async def get_object(self, patient_id, object_class, object_num):
+        return await self.call(self.bot.get_object, patient_id, object_class, object_num)
+
+    async def get_owner(self, patient_id):
+        return await self.call(self.bot.get_owner, patient_id)
+
+    async def get_page_objects(self, patient_id):
+        return await self.call(self.bot.get_page_objects, patient_id)
+
+    async def get_pedigree(self, patient_id):
+        return await self.call(self.bot.get_pedigree, patient_id)
+
+    async def get_relative(self, patient_id, relative_num):
+        return await self.call(self.bot.get_relative, patient_id, relative_num)
+
+    async def get_study(self, patient_id):
+        return await self.call(self.bot.get_study, patient_id)
+
+    async def get_vcf(self, patient_id, vcf_num):
+        return await self.call(self.bot.get_vcf, patient_id, vcf_num)
+
+    async def import_pedigree_ped(self, patient_id, pedigree_str, mark_evaluated=False, external_id_mark=True, accept_unknown_phenotypes=True):
+        await self.call_phantom(self.bot.import_pedigree_ped, patient_id, pedigree_str, mark_evaluated, external_id_mark, accept_unknown_phenotypes)
+
+    async def invalidate_cache(self, patient_id):
+        await self.call(self.bot.invalidate_cache, patient_id)
+
+    async def list(self, study=None, owner=None, having_object=None, since=None):
+        return await self.call(self.bot.list, study, owner, having_object, since)
+
+    async def list_class_properties(self, class_name):
+        return await self.call(self.bot.list_class_properties, class_name)
+
+    async def list_collaborators(self, patient_id):
+        return await self.call(self.bot.list_collaborators, patient_id)
+
+    async def list_groups(self):
+        return await self.call(self.bot.list_groups)
+
+    async def list_hql(self, query):
+        return await self.call(self.bot.list_hql, query)
+
+    async def list_hql_objects(self, query, object_class):
+        return await self.call(self.bot.list_hql_objects, query, object_class)
+
+    async def list_objects(self, patient_id, object_class):
+        return await self.call(self.bot.list_objects, patient_id, object_class)
+
+    async def list_patient_dates(self, since=None, patient_ids=None, chunk_size=PhenoTipsBot.BULK_CHUNK_SIZE):
+        return await self.call(self.bot.list_patient_dates, since, patient_ids, chunk_size)
+
+    async def list_pages(self, space, having_object=None):
+        return await self.call(self.bot.list_pages, space, having_object)
+
+    async def list_patient_class_properties(self):
+        return await self.call(self.bot.list_patient_class_properties)
+
+    async def list_relatives(self, patient_id):
+        return await self.call(self.bot.list_relatives, patient_id)
+
+    async def list_studies(self):
+        return await self.call(self.bot.list_studies)
+
+    async def list_users(self):
+        return await self.call(self.bot.list_users)
+
+    async def list_vcfs(self, patient_id):
+        return await self.call(self.bot.list_vcfs, patient_id)
+
+    async def refresh_index(self):
+        await self.call(self.bot.refresh_index)
+
+    async def resolve_external_ids(self, external_ids, chunk_size=PhenoTipsBot.BULK_CHUNK_SIZE):
+        return await self.call(self.bot.resolve_external_ids, external_ids, chunk_size)
+
+    async def set(self, patient_id, patient_obj):
+        await self.call(self.bot.set, patient_id, patient_obj)
+
+    async def set_collaborator(self, patient_id, collaborator_num, collaborator_obj):
+        await self.call(self.bot.set_collaborator, patient_id, collaborator_num, collaborator_obj)
+
+    async def set_file(self, patient_id, filename, contents):
+        await self.call(self.bot.set_file, patient_id, filename, contents)
+
+    async def set_object(self, patient_id, object_class, object_num, object_obj):
+        await self.call(self.bot.set_object, patient_id, object_class, object_num, object_obj)
+
+    async def set_owner(self, patient_id, owner):
+        await self.call(self.bot.set_owner, patient_id, owner)
+
+    async def set_pedigree(self, patient_id, pedigree_obj):
+        await self.call_phantom(self.bot.set_pedigree, patient_id, pedigree_obj)
+
+    async def set_relative(self, patient_id, relative_num, relative_obj):
+        await self.call(self.bot.set_relative, patient_id, relative_num, relative_obj)
+
+    async def set_study(self, patient_id, study):
+        await self.call(self.bot.set_study, patient_id, study)
+
+    async def set_vcf(self, patient_id, vcf_num, vcf_obj):
+        await self.call(self.bot.set_vcf, patient_id, vcf_num, vcf_obj)
+
+    async def validate_cache(self, patient_ids):
+        await self.call(self.bot.validate_cache, patient_ids)
+
+    async def update(self, patient_id, patient_obj, current_obj=None):
+        return await self.call(self.bot.update, patient_id, patient_obj, current_obj)
+
+    async def update_object(self, patient_id, object_class, object_num, object_obj, current_obj=None):
+        return await self.call(self.bot.update_object, patient_id, object_class, object_num, object_obj, current_obj)
+
+    async def upload_file(self, patient_id, filepath):
+        await self.call(self.bot.upload_file, patient_id, filepath)
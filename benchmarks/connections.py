@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+#
+# Benchmark that counts the TCP connections PhenoTipsBot opens per 1,000
+# operations with and without keep-alive connection pooling
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from fakexwiki import FakeXWiki
+from phenotipsbot import PhenoTipsBot
+
+N_OPERATIONS = 1000
+
+def run(fake, keep_alive):
+    fake.reset_counters()
+    start_time = time.time()
+    with PhenoTipsBot(fake.base_url, 'Admin', 'admin', keep_alive=keep_alive) as bot:
+        patient_ids = list(fake.patients)
+        for i in range(N_OPERATIONS):
+            bot.get(patient_ids[i % len(patient_ids)])
+    return fake.connections, time.time() - start_time
+
+with FakeXWiki() as fake:
+    print('mode                     connections per ' + str(N_OPERATIONS) + ' ops   seconds')
+    for label, keep_alive in (('one connection per call', False), ('pooled keep-alive', True)):
+        connections, elapsed = run(fake, keep_alive)
+        print(label.ljust(25) + str(connections).rjust(26) + '   ' + '%.2f' % elapsed)
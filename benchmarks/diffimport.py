@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Benchmark that counts the patients that import-csv.py --diff sends when a
+# spreadsheet matches what the server already has
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import csv
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from fakexwiki import FakeXWiki
+from phenotipsbot import PhenoTipsBot
+import_csv = __import__('import-csv')
+
+N_PATIENTS = 1000
+N_CHANGED = 10
+COLUMNS = ('external_id', 'gender', 'date_of_birth', 'prop1', 'prop2')
+
+#the spreadsheet holds the patients as they are on the server, with the dates written as m/d/yyyy as a spreadsheet
+#program would, except that the first N_CHANGED patients have a different date of birth
+
+def write_csv(fake, path):
+    with open(path, 'w', newline='') as fd:
+        writer = csv.writer(fd)
+        writer.writerow(COLUMNS)
+        for n, patient_id in enumerate(sorted(fake.patients)):
+            patient = fake.patients[patient_id]['PhenoTips.PatientClass']['0']
+            birth_date = datetime.strptime(patient['date_of_birth'][:10], '%Y-%m-%d')
+            if n < N_CHANGED:
+                birth_date = birth_date.replace(day=2)
+            row = [patient[column] for column in COLUMNS]
+            row[COLUMNS.index('date_of_birth')] = str(birth_date.month) + '/' + str(birth_date.day) + '/' + str(birth_date.year)
+            writer.writerow(row)
+
+def run(fake, path, diff):
+    with PhenoTipsBot(fake.base_url, 'Admin', 'admin') as bot:
+        patients = import_csv.parse_csv_file(bot, path, lambda field: None, lambda value, field: None, lambda: None)
+        patient_ids = import_csv.get_patient_ids(bot, patients, lambda count: None)
+        fake.reset_counters()
+        return import_csv.import_patients(bot, patients, patient_ids, None, None, lambda count: None, diff=diff) + (fake.requests,)
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    path = tmpdir + '/patients.csv'
+    print('mode        created   updated   skipped   requests   seconds')
+    for label, diff in (('set', False), ('diff', True)):
+        with FakeXWiki(N_PATIENTS) as fake:
+            write_csv(fake, path)
+            created, updated, skipped, elapsed, requests = run(fake, path, diff)
+        print(label.ljust(8) + str(created).rjust(11) + str(updated).rjust(10) + str(skipped).rjust(10) + str(requests).rjust(11) +
+              ('%.2f' % elapsed.total_seconds()).rjust(10))
+    if updated != N_CHANGED:
+        print('Expected ' + str(N_CHANGED) + ' patients to be updated in diff mode')
+        sys.exit(1)
@@ -0,0 +1,291 @@
+# Minimal in-process imitation of the PhenoTips/XWiki REST API for benchmarks
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import unquote
+from urllib.parse import urlparse
+from xml.sax.saxutils import escape
+from xml.sax.saxutils import quoteattr
+
+NS = 'http://www.xwiki.org'
+DATE_PROPERTIES = ('date_of_birth',)
+
+def make_patient(n, n_props=60):
+    patient = {'external_id': 'bench:' + str(n), 'gender': 'MF'[n % 2], 'date_of_birth': '19%02d-%02d-01 00:00:00.0' % (n % 100, n % 12 + 1)}
+    for i in range(n_props):
+        patient['prop' + str(i)] = 'value ' + str(n * i) if i % 3 else ''
+    return patient
+
+def store_dates(form):
+    #XWiki keeps dates as timestamps and returns them with the time of day, whatever form they were sent in
+    for key in DATE_PROPERTIES:
+        if form.get(key):
+            form[key] = form[key][:10] + ' 00:00:00.0'
+    return form
+
+def property_type(prop_name):
+    return 'Date' if prop_name in DATE_PROPERTIES else 'String'
+
+def object_xml(object_class, object_num, object_obj):
+    xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    xml += '<object xmlns="' + NS + '"><className>' + object_class + '</className><number>' + object_num + '</number>'
+    for key, value in object_obj.items():
+        xml += '<property name=' + quoteattr(key) + ' type="String"><value>' + escape(value) + '</value></property>'
+    return xml + '</object>'
+
+def page_xml(patient_id, objects):
+    #objects is None to leave them out, as servers before XWiki 7.3 do
+    xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><page xmlns="' + NS + '"><id>xwiki:data.' + patient_id + '</id>'
+    if objects != None:
+        xml += '<objects>'
+        for object_class, object_num, object_obj in objects:
+            xml += '<objectSummary' + object_xml(object_class, object_num, object_obj)[len('<?xml version="1.0" encoding="UTF-8" standalone="yes"?><object'):-len('</object>')] + '</objectSummary>'
+        xml += '</objects>'
+    return xml + '</page>'
+
+def search_results_xml(results):
+    xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><searchResults xmlns="' + NS + '">'
+    for pagename, modified, object_class, object_obj in results:
+        xml += '<searchResult><type>page</type><id>' + escape(pagename) + '</id><modified>' + modified + '</modified>'
+        if object_obj != None:
+            xml += object_xml(object_class, '0', object_obj)[len('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'):]
+        xml += '</searchResult>'
+    return xml + '</searchResults>'
+
+def class_xml(prop_names):
+    xml = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?><class xmlns="' + NS + '"><id>PhenoTips.PatientClass</id>'
+    for prop_name in prop_names:
+        xml += '<property name=' + quoteattr(prop_name) + ' type="' + property_type(prop_name) + '"><attribute name="name" value=' + quoteattr(prop_name) + '/></property>'
+    return xml + '</class>'
+
+#the JSON that XWiki produces for the same resources when asked for application/json
+
+def object_json(object_class, object_num, object_obj):
+    properties = [{'name': key, 'type': 'String', 'value': value or '', 'attributes': []} for key, value in object_obj.items()]
+    return json.dumps({'className': object_class, 'number': int(object_num), 'properties': properties})
+
+def page_json(patient_id, objects):
+    page = {'id': 'xwiki:data.' + patient_id}
+    if objects != None:
+        page['objects'] = {'objectSummaries': [json.loads(object_json(object_class, object_num, object_obj)) for object_class, object_num, object_obj in objects]}
+    return json.dumps(page)
+
+def object_summaries_json(summaries):
+    return json.dumps({'objectSummaries': [{'className': object_class, 'number': int(object_num)} for object_class, object_num in summaries]})
+
+def search_results_json(results):
+    return json.dumps({'searchResults': [{'type': 'page', 'id': pagename, 'modified': modified} for pagename, modified, object_class, object_obj in results]})
+
+def class_json(prop_names):
+    properties = [{'name': prop_name, 'type': property_type(prop_name), 'attributes': [{'name': 'name', 'value': prop_name}]} for prop_name in prop_names]
+    return json.dumps({'id': 'PhenoTips.PatientClass', 'properties': properties})
+
+#serves PatientClass objects for a fixed set of patients and counts the TCP connections that clients open
+class FakeXWiki:
+    def __init__(self, n_patients=100, json=True, page_objects=True):
+        self.patients = {}
+        for n in range(1, n_patients + 1):
+            self.patients['P' + str(n).zfill(7)] = {'PhenoTips.PatientClass': {'0': make_patient(n)}}
+        self.modified = dict.fromkeys(self.patients, '2016-01-01T00:00:00-07:00')
+        self.connections = 0
+        self.requests = 0
+        self.json = json #whether to answer requests that accept JSON with JSON, like newer versions of XWiki
+        self.page_objects = page_objects #whether pages include their objects when asked, like XWiki 7.3 and later
+        self.bytes_sent = 0
+        self.lock = threading.Lock()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with fake.lock:
+                    fake.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body=b'', content_type='application/xml', headers={}):
+                with fake.lock:
+                    fake.requests += 1
+                    fake.bytes_sent += len(body)
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                if self.close_connection:
+                    self.send_header('Connection', 'close')
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def wants_json(self):
+                return fake.json and 'application/json' in self.headers.get('Accept', '')
+
+            def read_form(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                form = {}
+                for key, values in parse_qs(body, keep_blank_values=True).items():
+                    form[key[len('property#'):] if key.startswith('property#') else key] = values[0]
+                return form
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                path = unquote(url.path)
+                m = re.fullmatch(r'/rest/wikis/xwiki/spaces/data/pages/([^/]+)/objects/([^/]+)/([^/]+)', path)
+                if m:
+                    obj = fake.patients.get(m.group(1), {}).get(m.group(2), {}).get(m.group(3))
+                    if obj == None:
+                        return self.reply(404)
+                    if self.wants_json():
+                        return self.reply(200, object_json(m.group(2), m.group(3), obj).encode('utf-8'), 'application/json')
+                    return self.reply(200, object_xml(m.group(2), m.group(3), obj).encode('utf-8'))
+                m = re.fullmatch(r'/rest/wikis/xwiki/spaces/data/pages/([^/]+)/objects(?:/([^/]+))?', path)
+                if m:
+                    summaries = []
+                    for object_class, objects in fake.patients.get(m.group(1), {}).items():
+                        if m.group(2) in (None, object_class):
+                            summaries += [(object_class, object_num) for object_num in objects]
+                    if self.wants_json():
+                        return self.reply(200, object_summaries_json(summaries).encode('utf-8'), 'application/json')
+                    xml = '<objects xmlns="' + NS + '">'
+                    for object_class, object_num in summaries:
+                        xml += '<objectSummary><className>' + object_class + '</className><number>' + object_num + '</number></objectSummary>'
+                    return self.reply(200, (xml + '</objects>').encode('utf-8'))
+                m = re.fullmatch(r'/rest/wikis/xwiki/spaces/data/pages/([^/]+)', path)
+                if m:
+                    if m.group(1) not in fake.patients:
+                        return self.reply(404)
+                    objects = None
+                    if fake.page_objects and parse_qs(url.query).get('objects') == ['true']:
+                        objects = [(object_class, object_num, object_obj) for object_class, object_objs in fake.patients[m.group(1)].items()
+                                   for object_num, object_obj in object_objs.items()]
+                    if self.wants_json():
+                        return self.reply(200, page_json(m.group(1), objects).encode('utf-8'), 'application/json')
+                    return self.reply(200, page_xml(m.group(1), objects).encode('utf-8'))
+                if path == '/rest/wikis/xwiki/query':
+                    params = parse_qs(url.query)
+                    query = params['q'][0]
+                    object_class = params.get('className', [None])[0]
+                    patient_ids = list(fake.patients)
+                    m = re.search(r"doc\.fullName in \((.*?)\)", query)
+                    if m:
+                        wanted = set(name[len('data.'):] for name in re.findall(r"'((?:[^']|'')*)'", m.group(1)))
+                        patient_ids = [patient_id for patient_id in patient_ids if patient_id in wanted]
+                    m = re.search(r"eid_prop\.value in \((.*?)\)", query)
+                    if m:
+                        wanted = set(re.findall(r"'((?:[^']|'')*)'", m.group(1)))
+                        patient_ids = [patient_id for patient_id in patient_ids
+                                       if fake.patients[patient_id]['PhenoTips.PatientClass']['0'].get('external_id') in wanted]
+                    m = re.search(r"doc\.date >= '(.*?)'", query)
+                    if m:
+                        patient_ids = [patient_id for patient_id in patient_ids if fake.modified[patient_id][:19].replace('T', ' ') >= m.group(1)]
+                    if 'order by doc.date' in query:
+                        patient_ids.sort(key=lambda patient_id: fake.modified[patient_id])
+                    elif 'order by doc.fullName' in query:
+                        patient_ids.sort()
+                    start = int(params.get('start', ['0'])[0])
+                    number = int(params.get('number', ['-1'])[0])
+                    patient_ids = patient_ids[start:] if number < 0 else patient_ids[start:start + number]
+                    results = []
+                    for patient_id in patient_ids:
+                        object_obj = fake.patients[patient_id].get(object_class, {}).get('0') if object_class else None
+                        results.append(('xwiki:data.' + patient_id, fake.modified[patient_id], object_class, object_obj))
+                    if self.wants_json():
+                        return self.reply(200, search_results_json(results).encode('utf-8'), 'application/json')
+                    return self.reply(200, search_results_xml(results).encode('utf-8'))
+                if path.startswith('/rest/wikis/xwiki/classes/'):
+                    if self.wants_json():
+                        return self.reply(200, class_json(make_patient(0)).encode('utf-8'), 'application/json')
+                    return self.reply(200, class_xml(make_patient(0)).encode('utf-8'))
+                if path.startswith('/bin/edit/data/'):
+                    return self.reply(200, b'<html></html>', 'text/html')
+                self.reply(404)
+
+            def do_POST(self):
+                form = self.read_form()
+                path = unquote(urlparse(self.path).path)
+                if path == '/rest/patients':
+                    with fake.lock:
+                        patient_id = 'P' + str(len(fake.patients) + 1).zfill(7)
+                        fake.patients[patient_id] = {'PhenoTips.PatientClass': {'0': {}}}
+                        fake.touch(patient_id)
+                    return self.reply(201, headers={'Location': 'http://localhost/rest/patients/' + patient_id})
+                m = re.fullmatch(r'/rest/wikis/xwiki/spaces/data/pages/([^/]+)/objects', path)
+                if m and m.group(1) in fake.patients:
+                    object_class = form.pop('className')
+                    with fake.lock:
+                        objects = fake.patients[m.group(1)].setdefault(object_class, {})
+                        object_num = str(len(objects))
+                        objects[object_num] = store_dates(form)
+                        fake.touch(m.group(1))
+                    return self.reply(201, headers={'Location': 'http://localhost' + path + '/' + object_class + '/' + object_num})
+                self.reply(404)
+
+            def do_PUT(self):
+                form = self.read_form()
+                path = unquote(urlparse(self.path).path)
+                m = re.fullmatch(r'/rest/wikis/xwiki/spaces/data/pages/([^/]+)/objects/([^/]+)/([^/]+)', path)
+                if m and m.group(3) in fake.patients.get(m.group(1), {}).get(m.group(2), {}):
+                    with fake.lock:
+                        fake.patients[m.group(1)][m.group(2)][m.group(3)].update(store_dates(form))
+                        fake.touch(m.group(1))
+                    return self.reply(202)
+                self.reply(404)
+
+            def do_DELETE(self):
+                path = unquote(urlparse(self.path).path)
+                m = re.fullmatch(r'/rest/patients/([^/]+)', path)
+                if m and m.group(1) in fake.patients:
+                    with fake.lock:
+                        del fake.patients[m.group(1)]
+                        del fake.modified[m.group(1)]
+                    return self.reply(204)
+                self.reply(404)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:' + str(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def touch(self, patient_id):
+        #fake modification dates advance by one second per change
+        self.clock = getattr(self, 'clock', 0) + 1
+        self.modified[patient_id] = '2016-01-02T%02d:%02d:%02d-07:00' % (self.clock // 3600 % 24, self.clock // 60 % 60, self.clock % 60)
+
+    def reset_counters(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.bytes_sent = 0
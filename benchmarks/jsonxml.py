@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+#
+# Benchmark that compares the size and client parse time of JSON and XML
+# responses recorded from the same REST resources
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import io
+import json
+import os
+import requests
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from fakexwiki import FakeXWiki
+from phenotipsbot import PhenoTipsBot
+
+N_PATIENTS = 20000
+N_REPEATS = 200
+
+NS = '{http://www.xwiki.org}'
+
+def xml_object(body):
+    return {el.attrib['name']: el.find(NS + 'value').text for el in PhenoTipsBot.parse_elements(io.BytesIO(body), NS + 'property')}
+
+def json_object(body):
+    return {prop['name']: prop.get('value') or None for prop in json.loads(body)['properties']}
+
+def xml_ids(body):
+    return list(map(PhenoTipsBot.result_id, PhenoTipsBot.parse_elements(io.BytesIO(body), NS + 'searchResult')))
+
+def json_ids(body):
+    return list(map(PhenoTipsBot.result_id, json.loads(body)['searchResults']))
+
+def xml_properties(body):
+    return [el.attrib['name'] for el in PhenoTipsBot.parse_elements(io.BytesIO(body), NS + 'property')]
+
+def json_properties(body):
+    return [prop['name'] for prop in json.loads(body)['properties']]
+
+#record each response in both formats so that only the parsing is timed
+with FakeXWiki(N_PATIENTS) as fake:
+    def record(path, params=None):
+        url = fake.base_url + path
+        return (requests.get(url, params=params, headers={'Accept': 'application/xml'}).content,
+                requests.get(url, params=params, headers={'Accept': 'application/json'}).content)
+
+    responses = (
+        ('patient object', record('/rest/wikis/xwiki/spaces/data/pages/P0000001/objects/PhenoTips.PatientClass/0'), xml_object, json_object),
+        (str(N_PATIENTS) + ' query IDs', record('/rest/wikis/xwiki/query', {'q': 'where doc.space = \'data\'', 'type': 'hql'}), xml_ids, json_ids),
+        ('class properties', record('/rest/wikis/xwiki/classes/PhenoTips.PatientClass'), xml_properties, json_properties),
+    )
+
+print('response               format        bytes   parse ms')
+for label, bodies, xml_parse, json_parse in responses:
+    results = []
+    for format_label, body, parse in (('XML', bodies[0], xml_parse), ('JSON', bodies[1], json_parse)):
+        repeats = 1 if len(body) > 1000000 else N_REPEATS
+        start_time = time.time()
+        for i in range(repeats):
+            result = parse(body)
+        elapsed = (time.time() - start_time) / repeats
+        results.append(result)
+        print(label.ljust(23) + format_label.ljust(6) + str(len(body)).rjust(13) + ('%.3f' % (elapsed * 1000)).rjust(11))
+    assert results[0] == results[1]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+#
+# Benchmark that compares normalizing the cells of a 1M-cell spreadsheet one at
+# a time with normalizing them through per-column compiled normalizers and
+# inferred date formats
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import csv
+import io
+import os
+import random
+import re
+import sys
+import time
+from datetime import date
+from datetime import timedelta
+from dateutil.parser import parse as parsedate
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+import_csv = __import__('import-csv')
+
+N_ROWS = 100000
+
+#one column of each kind of field, ten columns in all
+STATIC_VALUES = {'value' + str(n): 'Label ' + str(n) for n in range(50)}
+SCHEMA = {
+    'external_id': {'type': 'String', 'validationRegExp': '[a-z]+:[0-9]+'},
+    'first_name': {'type': 'String', 'validationRegExp': None},
+    'date_of_birth': {'type': 'Date'},
+    'unaffected': {'type': 'Boolean'},
+    'consanguinity': {'type': 'Boolean'},
+    'age': {'type': 'Number', 'numberType': 'integer'},
+    'weight': {'type': 'Number', 'numberType': 'double'},
+    'gender': {'type': 'StaticList', 'values': {'M': 'Male', 'F': 'Female', 'O': 'Other'}},
+    'ethnicity': {'type': 'StaticList', 'values': STATIC_VALUES},
+    'notes': {'type': 'TextArea', 'validationRegExp': None},
+}
+
+def make_value(field, n):
+    field_type = SCHEMA[field]['type']
+    if field == 'external_id':
+        return 'site:' + str(n)
+    elif field_type == 'Date':
+        #about 30,000 distinct birth dates, as in a large registry
+        birth_date = date(1940, 1, 1) + timedelta(days=random.randrange(30000))
+        return str(birth_date.month) + '/' + str(birth_date.day) + '/' + str(birth_date.year)
+    elif field_type == 'Boolean':
+        return random.choice(('Yes', 'no', 'TRUE', 'f', '1', 'maybe'))
+    elif field_type == 'Number':
+        return str(n % 100) if SCHEMA[field]['numberType'] == 'integer' else str(n % 100) + '.5'
+    elif field_type == 'StaticList':
+        key, label = random.choice(list(SCHEMA[field]['values'].items()))
+        return random.choice((key, label.upper(), ' ' + key.lower() + ' ', 'unknown'))
+    else:
+        return 'Text ' + str(n)
+
+#the per-cell normalize from before the schema was compiled, to compare against
+def normalize_per_cell(field_name, field_value, field_metadata):
+    field_value = field_value.strip()
+    field_type = field_metadata['type']
+    try:
+        if field_type == 'Date':
+            return parsedate(field_value).strftime('%Y-%m-%d')
+        elif field_type == 'Boolean':
+            field_value = field_value.lower()
+            if field_value in ('t', 'true', 'y', 'yes', '1'):
+                return '1'
+            elif field_value in ('f', 'false', 'n', 'no', '0'):
+                return '0'
+            else:
+                return None
+        elif field_type == 'Number':
+            if field_metadata['numberType'] in ('integer', 'long'):
+                return int(field_value)
+            else:
+                return float(field_value)
+        elif field_type == 'StaticList':
+            possible_values = field_metadata['values']
+            if not possible_values:
+                return field_value
+            field_value = field_value.lower()
+            for key, value in possible_values.items():
+                if field_value == key.lower() or field_value == value.lower():
+                    return key
+            return None
+        else:
+            validationRegex = field_metadata['validationRegExp']
+            if validationRegex and not re.fullmatch(validationRegex, field_value):
+                return None
+            return field_value
+    except ValueError:
+        return None
+
+random.seed(0)
+csv_file = io.StringIO()
+writer = csv.writer(csv_file)
+writer.writerow(SCHEMA.keys())
+for n in range(N_ROWS):
+    writer.writerow(make_value(field, n) for field in SCHEMA)
+csv_file.seek(0)
+rows = list(csv.DictReader(csv_file))
+
+def per_cell(columns):
+    return [[normalize_per_cell(field, row[field], SCHEMA[field]) for field in columns] for row in rows]
+
+def compiled(columns):
+    #the date formats are inferred from a sample of the rows, as import-csv.py does
+    sample = rows[:import_csv.DATE_SAMPLE_SIZE]
+    date_formats = {field: import_csv.infer_date_format([row[field] for row in sample])[0] for field in columns if SCHEMA[field]['type'] == 'Date'}
+    normalizers = [(field, import_csv.compile_normalizer(SCHEMA[field], date_formats.get(field))) for field in columns]
+    return [[normalize_value(row[field]) for field, normalize_value in normalizers] for row in rows]
+
+#dates are timed on their own because parsing them takes most of the time
+columns_without_dates = [field for field in SCHEMA if SCHEMA[field]['type'] != 'Date']
+print('columns          cells   per-cell seconds   compiled seconds')
+for label, columns in (('all', list(SCHEMA)), ('all but dates', columns_without_dates), ('dates', ['date_of_birth'])):
+    times = []
+    results = []
+    for normalize_rows in (per_cell, compiled):
+        start_time = time.time()
+        results.append(normalize_rows(columns))
+        times.append(time.time() - start_time)
+    assert results[0] == results[1]
+    print(label.ljust(13) + str(N_ROWS * len(columns)).rjust(10) + ('%.2f' % times[0]).rjust(19) + ('%.2f' % times[1]).rjust(19))
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+#
+# Benchmark that compares the memory held by patient objects stored as plain
+# dicts and as CompactRecords
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from fakexwiki import make_patient
+from phenotipsbot import CompactRecord
+
+N_PATIENTS = 100000
+
+def parsed_patient(n):
+    #property names and values are separate strings in every parsed object, as they are after parsing XML
+    return {(' ' + key)[1:]: (' ' + value)[1:] if value else None for key, value in make_patient(n).items()}
+
+def measure(record_type):
+    tracemalloc.start()
+    start_time = time.time()
+    patients = [record_type(parsed_patient(n)) for n in range(N_PATIENTS)]
+    build_time = time.time() - start_time
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start_time = time.time()
+    n_female = sum(1 for patient in patients if patient['gender'] == 'F')
+    read_time = time.time() - start_time
+    return held, build_time, read_time
+
+print('record type      held by ' + str(N_PATIENTS) + ' patients (MB)   build seconds   read seconds')
+for label, record_type in (('dict', dict), ('CompactRecord', CompactRecord)):
+    held, build_time, read_time = measure(record_type)
+    print(label.ljust(15) + ('%.1f' % (held / 1e6)).rjust(33) + ('%.2f' % build_time).rjust(16) + ('%.2f' % read_time).rjust(15))
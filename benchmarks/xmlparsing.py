@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Benchmark that compares the peak memory and time of parsing large recorded
+# REST responses into a full tree and incrementally with iterparse
+#
+# Copyright 2015 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import io
+import os
+import requests
+import sys
+import time
+import tracemalloc
+from xml.etree import ElementTree
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+from fakexwiki import FakeXWiki
+from fakexwiki import class_xml
+from phenotipsbot import PhenoTipsBot
+
+N_PATIENTS = 20000
+N_OBJECTS = 5000
+N_CLASS_PROPERTIES = 5000
+
+NS = '{http://www.xwiki.org}'
+
+def tree_ids(body):
+    root = ElementTree.fromstring(body.decode('utf-8'))
+    return list(map(lambda el: el.text, root.findall('./' + NS + 'searchResult/' + NS + 'id')))
+
+def stream_ids(body):
+    return list(map(lambda el: el.find(NS + 'id').text, PhenoTipsBot.parse_elements(io.BytesIO(body), NS + 'searchResult')))
+
+def tree_objects(body):
+    root = ElementTree.fromstring(body.decode('utf-8'))
+    ret = []
+    for result in root.findall('./' + NS + 'searchResult'):
+        ret.append((result.find('./' + NS + 'id').text, PhenoTipsBot.parse_properties(result.find('./' + NS + 'object'))))
+    return ret
+
+def stream_objects(body):
+    ret = []
+    for result in PhenoTipsBot.parse_elements(io.BytesIO(body), NS + 'searchResult'):
+        ret.append((result.find(NS + 'id').text, PhenoTipsBot.parse_properties(result.find(NS + 'object'))))
+    return ret
+
+def tree_properties(body):
+    root = ElementTree.fromstring(body.decode('utf-8'))
+    return list(map(lambda el: el.attrib['name'], root.iter(NS + 'property')))
+
+def stream_properties(body):
+    return list(map(lambda el: el.attrib['name'], PhenoTipsBot.parse_elements(io.BytesIO(body), NS + 'property')))
+
+def measure(parse, body):
+    tracemalloc.start()
+    start_time = time.time()
+    result = parse(body)
+    elapsed = time.time() - start_time
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, peak, elapsed
+
+#record the responses once so that only the parsing is measured
+with FakeXWiki(N_PATIENTS) as fake:
+    url = fake.base_url + '/rest/wikis/xwiki/query'
+    id_response = requests.get(url, params={'q': 'where doc.space = \'data\'', 'type': 'hql'}).content
+    object_response = requests.get(url, params={'q': 'where doc.space = \'data\'', 'type': 'hql', 'className': 'PhenoTips.PatientClass', 'number': N_OBJECTS}).content
+class_response = class_xml(['prop' + str(i) for i in range(N_CLASS_PROPERTIES)]).encode('utf-8')
+
+print('response                      size (MB)   parser      peak memory (MB)   seconds')
+for label, body, parsers in (
+    (str(N_PATIENTS) + ' query IDs', id_response, (tree_ids, stream_ids)),
+    (str(N_OBJECTS) + ' query objects', object_response, (tree_objects, stream_objects)),
+    (str(N_CLASS_PROPERTIES) + ' class properties', class_response, (tree_properties, stream_properties)),
+):
+    results = []
+    for parser_label, parse in zip(('tree', 'iterparse'), parsers):
+        result, peak, elapsed = measure(parse, body)
+        results.append(result)
+        print(label.ljust(30) + ('%.1f' % (len(body) / 1e6)).rjust(9) + '   ' + parser_label.ljust(10) + ('%.1f' % (peak / 1e6)).rjust(18) + '   ' + '%.2f' % elapsed)
+    assert results[0] == results[1]
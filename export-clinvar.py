@@ -29,27 +29,33 @@ from datetime import timedelta
 from dateutil.parser import parse as parsedate
 from getopt import getopt
 from getpass import getpass
+from phenotipsbot import CompactRecord
+from phenotipsbot import MetadataCache
+from phenotipsbot import ObjectCache
 from phenotipsbot import PhenoTipsBot
 from sys import stdout
 
 def get_clinvar_data(bot, patient_ids, gene, progress_callback):
     start_time = time.time()
     count = 0
+    patient_ids = list(patient_ids)
 
     clinvar_data = OrderedDict()
 
     for patient_id in patient_ids:
+        if bot.object_cache and count % bot.BULK_CHUNK_SIZE == 0:
+            #the modification dates of each chunk are checked just before it is read, while they are still fresh
+            bot.validate_cache(patient_ids[count:count + bot.BULK_CHUNK_SIZE])
         count += 1
         progress_callback(count)
 
-        clinvar_variant_nums = bot.list_objects(patient_id, 'PhenoTips.ClinVarVariantClass')
-        if len(clinvar_variant_nums) == 0:
+        clinvar_variant_objs = bot.get_all_objects(patient_id, ['PhenoTips.ClinVarVariantClass'])['PhenoTips.ClinVarVariantClass']
+        if len(clinvar_variant_objs) == 0:
             continue
 
         patient_obj = bot.get(patient_id)
 
-        for clinvar_variant_num in clinvar_variant_nums:
-            clinvar_variant_obj = bot.get_object(patient_id, 'PhenoTips.ClinVarVariantClass', clinvar_variant_num)
+        for clinvar_variant_obj in clinvar_variant_objs.values():
             gene_symbol = clinvar_variant_obj.get('gene_symbol')
 
             if gene and (not gene_symbol or not gene in gene_symbol.upper().split(';')):
@@ -526,11 +532,14 @@ if __name__ == '__main__':
     base_url = None
     username = None
     password = None
+    metadata_cache_path = None
+    object_cache_path = None
+    mirror_path = None
     study = None
     owner = None
     gene = None
 
-    optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'gene='])
+    optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'metadata-cache=', 'object-cache=', 'mirror=', 'study=', 'owner=', 'gene='])
     for name, value in optlist:
         if name == '--base-url':
             base_url = value
@@ -538,6 +547,12 @@ if __name__ == '__main__':
             username = value
         elif name == '--password':
             password = value
+        elif name == '--metadata-cache':
+            metadata_cache_path = value
+        elif name == '--object-cache':
+            object_cache_path = value
+        elif name == '--mirror':
+            mirror_path = value
         elif name == '--gene':
             gene = value.upper()
         elif name == '--study':
@@ -567,7 +582,11 @@ if __name__ == '__main__':
     if not password:
         password = 'admin'
 
-    bot = PhenoTipsBot(base_url, username, password)
+    metadata_cache = MetadataCache(metadata_cache_path) if metadata_cache_path else None
+    object_cache = ObjectCache(object_cache_path) if object_cache_path else None
+    #the patients and variants are all held in memory until the files are written
+    bot = PhenoTipsBot(base_url, username, password, metadata_cache=metadata_cache, object_cache=object_cache, mirror_path=mirror_path,
+                       record_type=CompactRecord)
 
     if study == None and len(bot.list_studies()):
         study = input('Are you submitting on a particular study (blank for no)? ')
@@ -614,3 +633,5 @@ if __name__ == '__main__':
 
     print('Exported ' + str(n_variants) + ' variants and ' + str(n_cases) + ' cases.')
     print('Elapsed time ' + str(elapsed_time1 + elapsed_time2))
+
+    bot.close()
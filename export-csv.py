@@ -19,17 +19,92 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
+import asyncio
 import csv
+import json
+import os
 import sys
 import time
+from asyncphenotipsbot import AsyncPhenoTipsBot
+from collections import deque
 from datetime import timedelta
 from getopt import getopt
 from getpass import getpass
+from itertools import islice
+from phenotipsbot import MetadataCache
+from phenotipsbot import ObjectCache
 from phenotipsbot import PhenoTipsBot
+from requests import HTTPError
 from sys import stderr
 from sys import stdout
 
-def export_patients(bot, patient_ids, out_file, progress_callback):
+def iter_chunks(patient_ids, chunk_size):
+    patient_ids = iter(patient_ids)
+    while True:
+        chunk = list(islice(patient_ids, chunk_size))
+        if not chunk:
+            break
+        yield chunk
+
+def get_chunk(bot, chunk):
+    patients = bot.get_bulk(chunk)
+    ret = []
+    for patient_id in chunk:
+        if patient_id in patients:
+            ret.append((patient_id, patients[patient_id]))
+            continue
+        #fall back to a single request for a patient that the bulk query did not return, and leave out a patient that
+        #was deleted after the list was made, which the next run with --state-file reports as deleted
+        try:
+            ret.append((patient_id, bot.get(patient_id)))
+        except HTTPError as err:
+            if err.response.status_code != 404:
+                raise
+    return ret
+
+async def get_chunk_async(bot, chunk):
+    patients = await bot.get_bulk(chunk)
+    ret = []
+    for patient_id in chunk:
+        if patient_id in patients:
+            ret.append((patient_id, patients[patient_id]))
+            continue
+        try:
+            ret.append((patient_id, await bot.get(patient_id)))
+        except HTTPError as err:
+            if err.response.status_code != 404:
+                raise
+    return ret
+
+def get_patients_in_chunks(bot, patient_ids, workers=None, ordered=True, depth=None):
+    #with workers, several chunks are downloaded at once and at most depth of them are held, in flight or waiting to
+    #be written, so memory does not depend on the number of patients
+    if not workers:
+        for chunk in iter_chunks(patient_ids, bot.BULK_CHUNK_SIZE):
+            for patient_id, patient in get_chunk(bot, chunk):
+                yield patient_id, patient, None
+        return
+    for chunk, patients, error in bot.map_batch(lambda chunk: get_chunk(bot, chunk), iter_chunks(patient_ids, bot.BULK_CHUNK_SIZE),
+                                                workers, ordered, depth=depth):
+        if error:
+            yield chunk[0], None, error
+            return
+        for patient_id, patient in patients:
+            yield patient_id, patient, None
+
+def read_state(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as fd:
+        return json.load(fd)
+
+def write_state(path, state):
+    #an interrupted run leaves the previous state intact
+    with open(path + '.tmp', 'w') as fd:
+        json.dump(state, fd)
+    os.replace(path + '.tmp', path)
+
+def export_patients(bot, patient_ids, out_file, progress_callback, workers=None, ordered=True, depth=None):
     start_time = time.time()
     count = 0
     n_exported = 0
@@ -39,11 +114,14 @@ def export_patients(bot, patient_ids, out_file, progress_callback):
     writer = csv.writer(out_file)
     writer.writerow(prop_names)
 
-    for patient_id in patient_ids:
+    patients = get_patients_in_chunks(bot, patient_ids, workers, ordered, depth)
+
+    for patient_id, patient, error in patients:
         progress_callback(count)
         count += 1
 
-        patient = bot.get(patient_id)
+        if error:
+            raise error
         row = []
         for prop_name in prop_names:
             row.append(patient[prop_name])
@@ -52,6 +130,59 @@ def export_patients(bot, patient_ids, out_file, progress_callback):
 
     return n_exported, timedelta(seconds=time.time() - start_time)
 
+async def export_patients_async(bot, patient_ids, out_file, progress_callback, ordered=True, depth=None):
+    start_time = time.time()
+    count = 0
+    n_exported = 0
+
+    prop_names = await bot.list_patient_class_properties()
+
+    writer = csv.writer(out_file)
+    writer.writerow(prop_names)
+
+    #keep up to depth chunks in flight; in order, finished chunks wait behind a slow one in the reorder buffer instead of
+    #the whole window waiting for its slowest chunk, and no more chunks are started until the slow one is written
+    depth = depth or bot.max_in_flight * 2
+    pending = deque() if ordered else set()
+
+    async def finished_chunks(limit):
+        while len(pending) > limit:
+            if ordered:
+                yield await pending.popleft()
+            else:
+                done, not_done = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.remove(task)
+                    yield task.result()
+
+    async def write_chunks(limit):
+        nonlocal count, n_exported
+        async for patients in finished_chunks(limit):
+            for patient_id, patient in patients:
+                progress_callback(count)
+                count += 1
+
+                row = []
+                for prop_name in prop_names:
+                    row.append(patient[prop_name])
+                writer.writerow(row)
+                n_exported += 1
+
+    try:
+        for chunk in iter_chunks(patient_ids, bot.bot.BULK_CHUNK_SIZE):
+            task = asyncio.ensure_future(get_chunk_async(bot, chunk))
+            if ordered:
+                pending.append(task)
+            else:
+                pending.add(task)
+            await write_chunks(depth - 1)
+        await write_chunks(0)
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return n_exported, timedelta(seconds=time.time() - start_time)
+
 if __name__ == '__main__':
 
     #parse arguments
@@ -59,10 +190,21 @@ if __name__ == '__main__':
     base_url = None
     username = None
     password = None
+    metadata_cache_path = None
+    object_cache_path = None
+    mirror_path = None
     study = None
     owner = None
+    max_in_flight = None
+    workers = None
+    depth = None
+    ordered = True
+    since = None
+    state_path = None
+    tombstones_path = None
 
-    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner='])
+    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'metadata-cache=', 'object-cache=', 'mirror=', 'study=', 'owner=', 'max-in-flight=', 'workers=', 'depth=',
+                                                'unordered', 'since=', 'state-file=', 'tombstones='])
     for name, value in optlist:
         if name == '--base-url':
             base_url = value
@@ -70,10 +212,34 @@ if __name__ == '__main__':
             username = value
         elif name == '--password':
             password = value
+        elif name == '--metadata-cache':
+            metadata_cache_path = value
+        elif name == '--object-cache':
+            object_cache_path = value
+        elif name == '--mirror':
+            mirror_path = value
         elif name == '--study':
             study = value
         elif name == '--owner':
             owner = value
+        elif name == '--max-in-flight':
+            max_in_flight = int(value)
+        elif name == '--workers':
+            workers = int(value)
+        elif name == '--depth':
+            depth = int(value)
+        elif name == '--unordered':
+            ordered = False
+        elif name == '--since':
+            since = value
+        elif name == '--state-file':
+            state_path = value
+        elif name == '--tombstones':
+            tombstones_path = value
+
+    if (depth or not ordered) and not (max_in_flight or workers):
+        stderr.write('--depth and --unordered only apply to exports with --max-in-flight or --workers.\n')
+        exit(1)
 
     #get any missing arguments and initialize the bot
 
@@ -97,7 +263,15 @@ if __name__ == '__main__':
     if not password:
         password = 'admin'
 
-    bot = PhenoTipsBot(base_url, username, password)
+    metadata_cache = MetadataCache(metadata_cache_path) if metadata_cache_path else None
+    object_cache = ObjectCache(object_cache_path) if object_cache_path else None
+    if max_in_flight:
+        async_bot = AsyncPhenoTipsBot(base_url, username, password, max_in_flight=max_in_flight, metadata_cache=metadata_cache,
+                                      object_cache=object_cache, mirror_path=mirror_path)
+        bot = async_bot.bot
+    else:
+        bot = PhenoTipsBot(base_url, username, password, pool_size=workers or PhenoTipsBot.POOL_SIZE, metadata_cache=metadata_cache,
+                           object_cache=object_cache, mirror_path=mirror_path)
 
     if study == None:
         studies = bot.list_studies()
@@ -128,13 +302,42 @@ if __name__ == '__main__':
 
     #begin export
 
-    patient_ids = bot.list(study, owner)
+    state = read_state(state_path)
+    if since == None:
+        since = state.get('since')
 
-    stderr.write('Exporting ' + str(len(patient_ids)) + ' patient records...\n')
+    if state_path:
+        #the next run picks up from the newest modification date on the server before this export starts
+        dates = bot.list_patient_dates(since)
+        all_patient_ids = bot.list(study, owner)
+        remaining_ids = set(all_patient_ids)
+        deleted_ids = [patient_id for patient_id in state.get('patient_ids', []) if patient_id not in remaining_ids]
+
+    #stream the patient list a page at a time instead of loading it all up front
+    patient_ids = bot.iter_list(study, owner, since=since)
+
+    if since:
+        stderr.write('Exporting patient records modified since ' + since + '...\n')
+    else:
+        stderr.write('Exporting patient records...\n')
     stderr.write('\n')
 
-    n_exported, elapsed_time = export_patients(bot, patient_ids, stdout, lambda count: stderr.write(str(count) + '\r'))
+    if max_in_flight:
+        n_exported, elapsed_time = asyncio.run(export_patients_async(async_bot, patient_ids, stdout, lambda count: stderr.write(str(count) + '\r'),
+                                                                     ordered, depth))
+    else:
+        n_exported, elapsed_time = export_patients(bot, patient_ids, stdout, lambda count: stderr.write(str(count) + '\r'), workers, ordered,
+                                                   depth)
 
     stderr.write('\n')
     stderr.write('Exported ' + str(n_exported) + ' patients.\n')
+    if state_path:
+        if tombstones_path:
+            with open(tombstones_path, 'w') as fd:
+                for patient_id in deleted_ids:
+                    fd.write(patient_id + '\n')
+        stderr.write('Deleted ' + str(len(deleted_ids)) + ' patients since the last run.\n')
+        write_state(state_path, {'since': max(dates.values()) if dates else since, 'patient_ids': all_patient_ids})
     stderr.write('Elapsed time ' + str(elapsed_time) + '\n')
+
+    bot.close()
@@ -25,6 +25,8 @@ import time
 from datetime import timedelta
 from getopt import getopt
 from getpass import getpass
+from phenotipsbot import MetadataCache
+from phenotipsbot import ObjectCache
 from phenotipsbot import PhenoTipsBot
 from sys import stderr
 from sys import stdout
@@ -34,10 +36,13 @@ from sys import stdout
 base_url = None
 username = None
 password = None
+metadata_cache_path = None
+object_cache_path = None
+mirror_path = None
 study = None
 owner = None
 
-optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner='])
+optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'metadata-cache=', 'object-cache=', 'mirror=', 'study=', 'owner='])
 for name, value in optlist:
     if name == '--base-url':
         base_url = value
@@ -45,6 +50,12 @@ for name, value in optlist:
         username = value
     elif name == '--password':
         password = value
+    elif name == '--metadata-cache':
+        metadata_cache_path = value
+    elif name == '--object-cache':
+        object_cache_path = value
+    elif name == '--mirror':
+        mirror_path = value
     elif name == '--study':
         study = value
     elif name == '--owner':
@@ -72,7 +83,9 @@ if not password:
 if not password:
     password = 'admin'
 
-bot = PhenoTipsBot(base_url, username, password)
+metadata_cache = MetadataCache(metadata_cache_path) if metadata_cache_path else None
+object_cache = ObjectCache(object_cache_path) if object_cache_path else None
+bot = PhenoTipsBot(base_url, username, password, metadata_cache=metadata_cache, object_cache=object_cache, mirror_path=mirror_path)
 
 if study == None:
     studies = bot.list_studies()
@@ -118,9 +131,13 @@ fid = study if study else '0'
 
 for patient_id in patient_ids:
     stderr.write(str(count) + '\r')
+    if object_cache and count % bot.BULK_CHUNK_SIZE == 0:
+        #the modification dates of each chunk are checked just before it is read, while they are still fresh
+        bot.validate_cache(patient_ids[count:count + bot.BULK_CHUNK_SIZE])
     count += 1
 
-    patient = bot.get(patient_id)
+    objects = bot.get_all_objects(patient_id, ['PhenoTips.PatientClass', 'PhenoTips.RelativeClass'])
+    patient = objects['PhenoTips.PatientClass']['0']
     iid = patient['external_id']
     pat = '0'
     mat = '0'
@@ -137,8 +154,7 @@ for patient_id in patient_ids:
     else:
         phenotype = 0
 
-    for relative_num in bot.list_relatives(patient_id):
-        relative_obj = bot.get_relative(patient_id, relative_num)
+    for relative_num, relative_obj in objects['PhenoTips.RelativeClass'].items():
         relative_eid = relative_obj['relative_of']
         if not relative_eid:
             raise Exception('Relative ' + relative_num + ' of patient ' + patient_id + ' is malformed')
@@ -160,3 +176,5 @@ for patient_id in patient_ids:
 
 stderr.write('\n')
 stderr.write('All done! Elapsed time ' + str(timedelta(seconds=time.time() - start_time)) + '\n')
+
+bot.close()
@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+from phenotipsbot import MetadataCache
 from phenotipsbot import PhenoTipsBot
 from PyQt5 import uic
 from PyQt5.QtCore import pyqtSlot
@@ -17,6 +18,7 @@ from sys import exit
 from threading import Thread
 parse_csv_file = __import__('import-csv').parse_csv_file
 get_patient_ids = __import__('import-csv').get_patient_ids
+count_rows = __import__('import-csv').count_rows
 import_patients = __import__('import-csv').import_patients
 export_patients = __import__('export-csv').export_patients
 get_clinvar_data = __import__('export-clinvar').get_clinvar_data
@@ -30,6 +32,8 @@ class MainWindow(QMainWindow):
     def __init__(self):
         super(MainWindow, self).__init__()
         uic.loadUi('mainwindow.ui', self)
+        #remember the studies, users, work groups, and patient class properties between the pages after a login
+        self.metadata_cache = MetadataCache()
         self.statusLabel.setVisible(False)
         self.progressBar.setVisible(False)
         self.previousButton.clicked.connect(self.previousButton_clicked)
@@ -111,7 +115,9 @@ class MainWindow(QMainWindow):
         self.site = self.siteSelector.currentText().rstrip('/')
         self.username = self.usernameTextbox.text()
         self.password = self.passwordTextbox.text()
-        self.bot = PhenoTipsBot(self.site, self.username, self.password)
+        #start each login from an empty cache so that the server checks the username and password again
+        self.metadata_cache.invalidate()
+        self.bot = PhenoTipsBot(self.site, self.username, self.password, metadata_cache=self.metadata_cache)
         try:
             self.studies = self.bot.list_studies()
             self.users = self.bot.list_users()
@@ -221,24 +227,36 @@ class MainWindow(QMainWindow):
             def identifierColumnHandler():
                 global confirmation
                 confirmation += 'WARNING: Ignoring identifier column; all existing patients must be identified using the external_id column and all new patients must receive new PhenoTips IDs.\n'
+            def ambiguousDateHandler(field, date_formats, date_format):
+                global confirmation
+                confirmation += 'WARNING: The dates in "' + field + '" could be read as ' + ' or '.join(date_formats) + '; reading them as ' + date_format + '\n'
 
             self.patients = parse_csv_file(
                 self.bot,
                 self.path,
                 unrecognizedColumnHandler,
                 unrecognizedValueHandler,
-                identifierColumnHandler
+                identifierColumnHandler,
+                ambiguousDateHandler
             )
 
+            def ambiguousIdHandler(external_id, patient_ids):
+                global confirmation
+                confirmation += 'WARNING: Leaving out the rows with external ID "' + external_id + '", which matches ' + ', '.join(patient_ids) + '\n'
+
             self.asyncSetStatus('Checking ' + str(len(self.patients)) + ' external IDs...', len(self.patients))
-            self.patient_ids = get_patient_ids(self.bot, self.patients, self.asyncSetProgress)
-            self.n_to_import = str(len(self.patients) - len(self.patient_ids))
-            self.n_to_update = str(len(self.patient_ids))
+            self.patient_ids = get_patient_ids(self.bot, self.patients, self.asyncSetProgress, ambiguous_id_callback=ambiguousIdHandler)
+            n_to_import, n_to_update, n_left_out = count_rows(self.patients, self.patient_ids)
+            self.n_to_import = str(n_to_import)
+            self.n_to_update = str(n_to_update)
         except Exception as err:
             self.asyncUnlockUi(str(err))
             return
 
-        confirmation += '\nYou are about to import ' + self.n_to_import + ' new patients and update ' + self.n_to_update + ' existing patients.'
+        confirmation += '\nYou are about to import ' + self.n_to_import + ' new patients and update ' + self.n_to_update + ' existing patients'
+        if n_left_out:
+            confirmation += ', leaving out ' + str(n_left_out) + ' rows with ambiguous external IDs'
+        confirmation += '.'
         self.asyncSetConfirmation(confirmation.strip())
         self.asyncSetPage(4)
         self.asyncUnlockUi()
@@ -248,13 +266,13 @@ class MainWindow(QMainWindow):
             self.asyncLockUi('Importing/updating...', len(self.patients))
 
             try:
-                elapsedTime = import_patients(self.bot, self.patients, self.patient_ids, self.study, self.owner, self.asyncSetProgress)
+                n_created, n_updated, n_skipped, elapsedTime = import_patients(self.bot, self.patients, self.patient_ids, self.study, self.owner, self.asyncSetProgress)
             except Exception as err:
                 self.asyncUnlockUi(str(err))
                 return
 
             self.asyncSetSummary(
-                'Imported ' + self.n_to_import + ' patients and updated ' + self.n_to_update + ' patients.\n' +
+                'Imported ' + str(n_created) + ' patients, updated ' + str(n_updated) + ' patients, and skipped ' + str(n_skipped) + ' unchanged patients.\n' +
                 'Elapsed time ' + str(elapsedTime)
             )
         elif self.operation == EXPORT_CSV:
@@ -19,60 +19,163 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
+import asyncio
 import csv
+import os
+import queue
 import re
 import sys
+import threading
 import time
+from asyncphenotipsbot import AsyncPhenoTipsBot
+from collections import OrderedDict
+from datetime import date
+from datetime import datetime
 from datetime import timedelta
+from functools import lru_cache
 from dateutil.parser import parse as parsedate
 from getopt import getopt
 from getpass import getpass
+from itertools import islice
+from phenotipsbot import ImportJournal
+from phenotipsbot import MetadataCache
 from phenotipsbot import PhenoTipsBot
 from sys import stdout
 from traceback import print_exc
 
-def normalize(field_name, field_value, field_metadata):
-    field_value = field_value.strip()
+QUEUE_SIZE = 1000 #rows between the stages of import_csv_file
+DATE_SAMPLE_SIZE = 1000 #rows read to infer the formats of the date columns
+DATE_CACHE_SIZE = 100000 #distinct values remembered per date column
+
+#formats that a date column can be read with quickly and strictly, month-first before day-first as dateutil reads them;
+#two-digit years are left to dateutil, which picks their century differently
+DATE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%d/%m/%Y', '%Y/%m/%d', '%m-%d-%Y', '%d-%m-%Y', '%d.%m.%Y',
+                '%d %b %Y', '%b %d %Y', '%b %d, %Y', '%d-%b-%Y', '%d %B %Y', '%B %d %Y', '%B %d, %Y')
+
+TRUE_VALUES = frozenset(('t', 'true', 'y', 'yes', '1'))
+FALSE_VALUES = frozenset(('f', 'false', 'n', 'no', '0'))
+
+def date_parser(date_format):
+    if date_format == '%Y-%m-%d':
+        return date.fromisoformat
+    return lambda value: datetime.strptime(value, date_format).date()
+
+def infer_date_format(values):
+    #returns the format that reads the most values, and if other formats read as many values but as different dates,
+    #a list of all of those formats
+    best_count = 0
+    candidates = []
+    for date_format in DATE_FORMATS:
+        parse = date_parser(date_format)
+        dates = []
+        for value in values:
+            try:
+                dates.append(parse(value))
+            except ValueError:
+                dates.append(None)
+        count = len(dates) - dates.count(None)
+        if count > best_count:
+            best_count = count
+            candidates = [(date_format, dates)]
+        elif count and count == best_count:
+            candidates.append((date_format, dates))
+
+    #a column that is mostly in no strict format is left to dateutil
+    if not best_count or best_count * 2 < len(values):
+        return None, []
+    date_format, dates = candidates[0]
+    ambiguous_formats = [other_format for other_format, other_dates in candidates[1:] if other_dates != dates]
+    return date_format, [date_format] + ambiguous_formats if ambiguous_formats else []
+
+def infer_date_formats(possible_fields, file_name, ambiguous_date_callback=None):
+    #samples the first rows of the file to choose a format for each date column
+    reader = csv.DictReader(open(file_name, 'r'))
+    date_fields = [field for field in reader.fieldnames if field in possible_fields and possible_fields[field]['type'] == 'Date']
+    samples = {field: [] for field in date_fields}
+    if date_fields:
+        for row in islice(reader, DATE_SAMPLE_SIZE):
+            for field in date_fields:
+                value = (row[field] or '').strip()
+                if value:
+                    samples[field].append(value)
+
+    date_formats = {}
+    for field in date_fields:
+        date_formats[field], ambiguous_formats = infer_date_format(samples[field])
+        if ambiguous_formats and ambiguous_date_callback:
+            ambiguous_date_callback(field, ambiguous_formats, date_formats[field])
+    return date_formats
+
+def compile_normalizer(field_metadata, date_format=None):
+    #returns a function that normalizes a value of the field, with all of the work that depends only on the field done once
     field_type = field_metadata['type']
-    try:
-        if field_type == 'Date':
-            return parsedate(field_value).strftime('%Y-%m-%d')
-        elif field_type == 'Boolean':
-            field_value = field_value.lower()
-            if field_value in ('t', 'true', 'y', 'yes', '1'):
+
+    if field_type == 'Date':
+        parse_strictly = date_parser(date_format) if date_format else None
+
+        #columns of dates repeat the same values many times, so each value is parsed only once
+        @lru_cache(maxsize=DATE_CACHE_SIZE)
+        def normalize_date(field_value):
+            if parse_strictly:
+                try:
+                    return parse_strictly(field_value).strftime('%Y-%m-%d')
+                except ValueError:
+                    pass
+            try:
+                return parsedate(field_value).strftime('%Y-%m-%d')
+            except ValueError:
+                return None
+
+        normalize_value = lambda field_value: normalize_date(field_value.strip())
+    elif field_type == 'Boolean':
+        def normalize_value(field_value):
+            field_value = field_value.strip().lower()
+            if field_value in TRUE_VALUES:
                 return '1'
-            elif field_value in ('f', 'false', 'n', 'no', '0'):
+            elif field_value in FALSE_VALUES:
                 return '0'
             else:
                 return None
-        elif field_type == 'Number':
-            if field_metadata['numberType'] in ('integer', 'long'):
-                return int(field_value)
-            else:
-                return float(field_value)
-        elif field_type == 'StaticList':
-            possible_values = field_metadata['values']
-            if not possible_values:
-                return field_value
-            field_value = field_value.lower()
-            for key, value in possible_values.items():
-                if field_value == key.lower() or field_value == value.lower():
-                    return key
-            return None
-        else:
-            validationRegex = field_metadata['validationRegExp']
-            if validationRegex and not re.fullmatch(validationRegex, field_value):
+    elif field_type == 'Number':
+        number_type = int if field_metadata.get('numberType') in ('integer', 'long') else float
+        def normalize_value(field_value):
+            try:
+                return number_type(field_value.strip())
+            except ValueError:
                 return None
-            return field_value
-    except ValueError:
-        return None
+    elif field_type == 'StaticList':
+        possible_values = field_metadata.get('values')
+        if not possible_values:
+            return lambda field_value: field_value.strip()
+        #earlier values take precedence, as they would in a scan through the list
+        lookup = {}
+        for key, value in reversed(list(possible_values.items())):
+            lookup[value.lower()] = key
+            lookup[key.lower()] = key
+        normalize_value = lambda field_value: lookup.get(field_value.strip().lower())
+    else:
+        validation_regex = field_metadata.get('validationRegExp')
+        if validation_regex:
+            fullmatch = re.compile(validation_regex).fullmatch
+            def normalize_value(field_value):
+                field_value = field_value.strip()
+                return field_value if fullmatch(field_value) else None
+        else:
+            normalize_value = lambda field_value: field_value.strip()
 
-def parse_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
-                   identifier_column_callback):
+    return normalize_value
+
+def normalize(field_name, field_value, field_metadata):
+    return compile_normalizer(field_metadata)(field_value)
+
+def iter_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
+                  identifier_column_callback, ambiguous_date_callback=None, date_formats=None):
+    #yields each row as a patient object as soon as it is read
     possible_fields = bot.list_patient_class_properties()
+    if date_formats == None:
+        date_formats = infer_date_formats(possible_fields, file_name, ambiguous_date_callback)
 
     reader = csv.DictReader(open(file_name, 'r'))
-    patients = []
 
     #warn about unrecognized fields
     for field in reader.fieldnames:
@@ -81,6 +184,10 @@ def parse_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_va
         if field not in possible_fields:
             unrecognized_column_callback(field)
 
+    #the schema is compiled once per column rather than looked up for every cell
+    normalizers = [(field, compile_normalizer(possible_fields[field], date_formats.get(field))) for field in reader.fieldnames
+                   if field != 'identifier' and field in possible_fields]
+
     for row in reader:
         #skip empty rows
         if len(row) == 0:
@@ -88,49 +195,308 @@ def parse_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_va
 
         patient = {}
 
-        for field in reader.fieldnames:
-            if field == 'identifier':
-                continue
+        for field, normalize_value in normalizers:
             value = row[field]
             if value == '':
                 continue
-            patient[field] = normalize(field, value, possible_fields[field])
-            if patient[field] == None:
-                del patient[field]
+            normalized_value = normalize_value(value)
+            if normalized_value == None:
                 unrecognized_value_callback(value, field)
+            else:
+                patient[field] = normalized_value
 
-        patients.append(patient)
+        yield patient
 
-    return patients
+def parse_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
+                   identifier_column_callback, ambiguous_date_callback=None):
+    return list(iter_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
+                              identifier_column_callback, ambiguous_date_callback))
 
-def get_patient_ids(bot, patients, progress_callback):
+def get_patient_ids(bot, patients, progress_callback, workers=None, ambiguous_id_callback=None):
+    #an external ID that matches several patients maps to the list of them, and its rows are left out of the import
     patient_ids = {}
     count = 0
 
-    for patient in patients:
-        external_id = patient.get('external_id')
-        if external_id:
-            patient_id = bot.get_id(external_id)
+    #look up the external IDs a chunk at a time instead of one request per row
+    external_ids = list(OrderedDict.fromkeys(patient['external_id'] for patient in patients if patient.get('external_id')))
+    chunks = [external_ids[start:start + bot.BULK_CHUNK_SIZE] for start in range(0, len(external_ids), bot.BULK_CHUNK_SIZE)]
+    if workers:
+        results = bot.map_batch(bot.resolve_external_ids, chunks, workers, ordered=False)
+    else:
+        results = ((chunk, bot.resolve_external_ids(chunk), None) for chunk in chunks)
+
+    for chunk, chunk_ids, error in results:
+        if error:
+            raise error
+        for external_id, patient_id in chunk_ids.items():
+            if type(patient_id) == list and ambiguous_id_callback:
+                ambiguous_id_callback(external_id, patient_id)
             if patient_id:
                 patient_ids[external_id] = patient_id
+        count += len(chunk)
+        progress_callback(count)
+
+    return patient_ids
+
+async def get_patient_ids_async(bot, patients, progress_callback, ambiguous_id_callback=None):
+    patient_ids = {}
+    count = 0
+
+    async def get_chunk_ids(chunk):
+        nonlocal count
+        for external_id, patient_id in (await bot.resolve_external_ids(chunk)).items():
+            if type(patient_id) == list and ambiguous_id_callback:
+                ambiguous_id_callback(external_id, patient_id)
+            if patient_id:
+                patient_ids[external_id] = patient_id
+        count += len(chunk)
+        progress_callback(count)
+
+    external_ids = list(OrderedDict.fromkeys(patient['external_id'] for patient in patients if patient.get('external_id')))
+    chunk_size = bot.bot.BULK_CHUNK_SIZE
+    await asyncio.gather(*[get_chunk_ids(external_ids[start:start + chunk_size]) for start in range(0, len(external_ids), chunk_size)])
+
+    return patient_ids
+
+def count_rows(patients, patient_ids):
+    #the numbers of rows that will create a patient, update one, and be left out because their external ID is ambiguous
+    n_new = 0
+    n_existing = 0
+    n_ambiguous = 0
+    for patient in patients:
+        patient_id = patient_ids.get(patient.get('external_id'))
+        if type(patient_id) == list:
+            n_ambiguous += 1
+        elif patient_id:
+            n_existing += 1
+        else:
+            n_new += 1
+    return n_new, n_existing, n_ambiguous
+
+def update_patient(bot, patient_id, patient, current_patients, diff):
+    #in diff mode only the changed properties are sent, and nothing at all if the row matches the server
+    if not diff:
+        bot.set(patient_id, patient)
+        return 'updated'
+    if bot.update(patient_id, patient, current_patients.get(patient_id)):
+        current_patients.pop(patient_id, None) #a later row for the same patient compares against the server again
+        return 'updated'
+    return 'skipped'
+
+async def update_patient_async(bot, patient_id, patient, current_patients, diff):
+    if not diff:
+        await bot.set(patient_id, patient)
+        return 'updated'
+    if await bot.update(patient_id, patient, current_patients.get(patient_id)):
+        current_patients.pop(patient_id, None)
+        return 'updated'
+    return 'skipped'
+
+def import_patient(bot, row_num, patient, patient_id, study, owner, current_patients, diff, journal):
+    #rows are journaled by their position in the file; finished rows are not imported again
+    key = str(row_num)
+    if journal and journal.get_result(key):
+        return journal.get_result(key)
+    if patient_id and not (journal and journal.get(key)):
+        result = update_patient(bot, patient_id, patient, current_patients, diff)
+    else:
+        #a patient that a stopped run began creating is finished rather than created again
+        bot.create(patient, study, owner, journal=journal, journal_key=key)
+        result = 'created'
+    if journal:
+        journal.put_result(key, result)
+    return result
+
+def import_patients(bot, patients, patient_ids, study, owner, progress_callback, workers=None, diff=False, journal=None):
+    count = 0
+    counts = {'created': 0, 'updated': 0, 'skipped': 0}
+    start_time = time.time()
+
+    #the existing patients are downloaded a chunk at a time to compare the rows against
+    #rows whose external ID matches several patients are left out
+    rows = [row for row in enumerate(patients) if type(patient_ids.get(row[1].get('external_id'))) != list]
+    existing_ids = [patient_id for patient_id in patient_ids.values() if type(patient_id) != list]
+    current_patients = dict(bot.get_bulk(OrderedDict.fromkeys(existing_ids))) if diff else {}
+
+    def import_row(row):
+        row_num, patient = row
+        return import_patient(bot, row_num, patient, patient_ids.get(patient.get('external_id')), study, owner, current_patients, diff, journal)
+
+    if workers:
+        #rows that update the same patient are applied in order; one failed row does not stop the others
+        first_error = None
+        for row, result, error in bot.map_batch(import_row, rows, workers, ordered=False,
+                                                key=lambda row: patient_ids.get(row[1].get('external_id'))):
+            if error:
+                if not first_error:
+                    first_error = error
+            else:
+                counts[result] += 1
+            count += 1
+            progress_callback(count)
+        if first_error:
+            raise first_error
+    else:
+        for row in rows:
+            counts[import_row(row)] += 1
             count += 1
             progress_callback(count)
 
-    return patient_ids
+    return counts['created'], counts['updated'], counts['skipped'], timedelta(seconds=time.time() - start_time)
 
-def import_patients(bot, patients, patient_ids, study, owner, progress_callback):
+async def import_patients_async(bot, patients, patient_ids, study, owner, progress_callback, diff=False, journal=None):
     count = 0
+    counts = {'created': 0, 'updated': 0, 'skipped': 0}
     start_time = time.time()
 
-    for patient in patients:
-        if patient_ids.get(patient.get('external_id')):
-            bot.set(patient_ids[patient['external_id']], patient)
+    existing_ids = [patient_id for patient_id in patient_ids.values() if type(patient_id) != list]
+    current_patients = dict(await bot.get_bulk(list(OrderedDict.fromkeys(existing_ids)))) if diff else {}
+
+    #rows that update the same patient are applied in order; everything else runs concurrently
+    updates = {}
+    creations = []
+    for row_num, patient in enumerate(patients):
+        key = str(row_num)
+        patient_id = patient_ids.get(patient.get('external_id'))
+        if type(patient_id) == list:
+            continue
+        if journal and journal.get_result(key):
+            counts[journal.get_result(key)] += 1
+            count += 1
+            continue
+        if patient_id and not (journal and journal.get(key)):
+            updates.setdefault(patient_id, []).append((key, patient))
         else:
-            bot.create(patient, study, owner)
+            creations.append((key, patient))
+    progress_callback(count)
+
+    async def update_patient(patient_id, rows):
+        nonlocal count
+        for key, patient in rows:
+            result = await update_patient_async(bot, patient_id, patient, current_patients, diff)
+            if journal:
+                journal.put_result(key, result)
+            counts[result] += 1
+            count += 1
+            progress_callback(count)
+
+    async def create_patient(row):
+        nonlocal count
+        key, patient = row
+        await bot.create(patient, study, owner, journal=journal, journal_key=key)
+        if journal:
+            journal.put_result(key, 'created')
+        counts['created'] += 1
         count += 1
         progress_callback(count)
 
-    return timedelta(seconds=time.time() - start_time)
+    await asyncio.gather(
+        *[update_patient(patient_id, rows) for patient_id, rows in updates.items()],
+        *map(create_patient, creations)
+    )
+
+    return counts['created'], counts['updated'], counts['skipped'], timedelta(seconds=time.time() - start_time)
+
+def buffered(items, size):
+    #runs the iteration on a thread of its own, at most size items ahead of the consumer
+    items_queue = queue.Queue(size)
+    end = object()
+
+    def produce():
+        try:
+            for item in items:
+                items_queue.put((item, None))
+            items_queue.put((end, None))
+        except Exception as err:
+            items_queue.put((end, err))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item, error = items_queue.get()
+        if error:
+            raise error
+        if item is end:
+            return
+        yield item
+
+def import_csv_file(bot, file_name, study, owner, unrecognized_column_callback, unrecognized_value_callback,
+                    identifier_column_callback, progress_callback, workers=None, diff=False, journal=None, queue_size=QUEUE_SIZE,
+                    date_formats=None, ambiguous_id_callback=None):
+    #parses, resolves, and uploads at the same time, with a bounded number of rows between each stage, so that the
+    #upload starts on the first rows and memory does not grow with the size of the file
+    count = 0
+    counts = {'created': 0, 'updated': 0, 'skipped': 0}
+    start_time = time.time()
+    lock = threading.Lock()
+    current_patients = {}
+    in_flight = {} #patient ID -> number of rows resolved but not yet uploaded
+    ambiguous_ids = set()
+
+    def resolve(rows):
+        #looks up the external IDs, and in diff mode the current patients, a chunk of rows at a time
+        while True:
+            chunk = list(islice(rows, bot.BULK_CHUNK_SIZE))
+            if not chunk:
+                return
+            external_ids = list(OrderedDict.fromkeys(
+                patient['external_id'] for row_num, patient in chunk
+                if patient.get('external_id') and not (journal and journal.get_result(str(row_num)))
+            ))
+            patient_ids = {}
+            for external_id, patient_id in bot.resolve_external_ids(external_ids).items():
+                if type(patient_id) == list:
+                    #rows that match several patients are left out, and each such external ID is reported once
+                    if external_id not in ambiguous_ids and ambiguous_id_callback:
+                        ambiguous_id_callback(external_id, patient_id)
+                    ambiguous_ids.add(external_id)
+                elif patient_id:
+                    patient_ids[external_id] = patient_id
+            resolved = []
+            for row_num, patient in chunk:
+                if patient.get('external_id') in ambiguous_ids and not (journal and journal.get_result(str(row_num))):
+                    continue
+                resolved.append((row_num, patient, patient_ids.get(patient.get('external_id'))))
+            fresh = []
+            with lock:
+                for row_num, patient, patient_id in resolved:
+                    if patient_id:
+                        #a patient with an earlier row still in flight must be compared after that row is uploaded
+                        if not in_flight.get(patient_id):
+                            fresh.append(patient_id)
+                        in_flight[patient_id] = in_flight.get(patient_id, 0) + 1
+            if diff and fresh:
+                for patient_id, patient_obj in bot.get_bulk(OrderedDict.fromkeys(fresh)).items():
+                    current_patients[patient_id] = patient_obj
+            yield from resolved
+
+    def import_row(row):
+        row_num, patient, patient_id = row
+        try:
+            return import_patient(bot, row_num, patient, patient_id, study, owner, current_patients, diff, journal)
+        finally:
+            if patient_id:
+                with lock:
+                    current_patients.pop(patient_id, None)
+                    in_flight[patient_id] -= 1
+                    if not in_flight[patient_id]:
+                        del in_flight[patient_id]
+
+    rows = buffered(enumerate(iter_csv_file(bot, file_name, unrecognized_column_callback, unrecognized_value_callback,
+                                            identifier_column_callback, date_formats=date_formats)), queue_size)
+    first_error = None
+    for row, result, error in bot.map_batch(import_row, buffered(resolve(rows), queue_size), workers, ordered=False,
+                                            key=lambda row: row[2]):
+        if error:
+            if not first_error:
+                first_error = error
+        else:
+            counts[result] += 1
+        count += 1
+        progress_callback(count)
+    if first_error:
+        raise first_error
+
+    return counts['created'], counts['updated'], counts['skipped'], timedelta(seconds=time.time() - start_time)
 
 if __name__ == '__main__':
 
@@ -143,11 +509,19 @@ if __name__ == '__main__':
     base_url = None
     username = None
     password = None
+    metadata_cache_path = None
     study = None
     owner = None
+    max_in_flight = None
+    index_path = None
+    diff = False
+    journal_path = None
+    resume = False
+    stream = False
     yes = False
 
-    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'owner=', 'yes'])
+    optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'metadata-cache=', 'index=', 'study=', 'owner=', 'max-in-flight=', 'diff',
+                                                'journal=', 'resume', 'stream', 'yes'])
     for name, value in optlist:
         if name == '--base-url':
             base_url = value
@@ -155,13 +529,34 @@ if __name__ == '__main__':
             username = value
         elif name == '--password':
             password = value
+        elif name == '--metadata-cache':
+            metadata_cache_path = value
         elif name == '--study':
             study = value
         elif name == '--owner':
             owner = value
+        elif name == '--max-in-flight':
+            max_in_flight = int(value)
+        elif name == '--index':
+            index_path = value
+        elif name == '--diff':
+            diff = True
+        elif name == '--journal':
+            journal_path = value
+        elif name == '--resume':
+            resume = True
+        elif name == '--stream':
+            stream = True
         elif name in ('-y', '--yes'):
             yes = True
 
+    if resume and not journal_path:
+        print('You must specify the journal of the import to resume with --journal.')
+        exit(1)
+    if journal_path and not resume and os.path.exists(journal_path) and os.path.getsize(journal_path):
+        print('The journal ' + journal_path + ' already exists. Pass --resume to continue the import that it records.')
+        exit(1)
+
     #get missing arguments and initialize the bot
 
     if not base_url:
@@ -182,17 +577,31 @@ if __name__ == '__main__':
     if not password:
         password = 'admin'
 
-    bot = PhenoTipsBot(base_url, username, password)
-
-    #parse CSV file
-
-    patients = parse_csv_file(
-        bot,
-        args[0],
-        lambda column: print('WARNING: Ignoring unrecognized column "' + column + '"'),
-        lambda value, field: print('WARNING: Ignoring unrecognized value "' + value + '" for "' + field + '"'),
-        lambda: print('WARNING: Ignoring identifier column; all existing patients must be identified using the external_id column and all new patients must receive new PhenoTips IDs.')
-    )
+    metadata_cache = MetadataCache(metadata_cache_path) if metadata_cache_path else None
+    if max_in_flight:
+        async_bot = AsyncPhenoTipsBot(base_url, username, password, max_in_flight=max_in_flight, index_path=index_path,
+                                      metadata_cache=metadata_cache)
+        bot = async_bot.bot
+    else:
+        bot = PhenoTipsBot(base_url, username, password, index_path=index_path, metadata_cache=metadata_cache)
+    if index_path:
+        print('Updating the external ID index...')
+        bot.refresh_index()
+
+    #parse CSV file, unless it is to be parsed during the import
+
+    unrecognized_column_callback = lambda column: print('WARNING: Ignoring unrecognized column "' + column + '"')
+    unrecognized_value_callback = lambda value, field: print('WARNING: Ignoring unrecognized value "' + value + '" for "' + field + '"')
+    identifier_column_callback = lambda: print('WARNING: Ignoring identifier column; all existing patients must be identified using the external_id column and all new patients must receive new PhenoTips IDs.')
+    ambiguous_date_callback = lambda field, date_formats, date_format: print('WARNING: The dates in "' + field + '" could be read as ' + ' or '.join(date_formats) + '; reading them as ' + date_format)
+    ambiguous_id_callback = lambda external_id, patient_ids: print('WARNING: Leaving out the rows with external ID "' + external_id + '", which matches ' + ', '.join(patient_ids))
+
+    if stream:
+        #report ambiguous date columns now rather than once the import is underway
+        date_formats = infer_date_formats(bot.list_patient_class_properties(), args[0], ambiguous_date_callback)
+    else:
+        patients = parse_csv_file(bot, args[0], unrecognized_column_callback, unrecognized_value_callback, identifier_column_callback,
+                                  ambiguous_date_callback)
 
     #get the rest of the missing arguments
 
@@ -219,17 +628,53 @@ if __name__ == '__main__':
     if not owner:
         owner = username
 
-    #check external IDs
-
-    print('Checking ' + str(len(patients)) + ' external IDs...')
+    #open the journal
+
+    journal = None
+    if journal_path:
+        journal = ImportJournal(journal_path)
+        journal.check_source(ImportJournal.hash_file(args[0]))
+        n_finished = len(journal.results)
+        if n_finished:
+            print('Skipping ' + str(n_finished) + ' rows that were finished before the import stopped.')
+
+    if stream:
+        #the external IDs are checked as the rows are read, so the numbers of new and existing patients are not known yet
+        if yes or input('You are about to import the patients in ' + args[0] + '. Type y to continue: ')[0] == 'y':
+            n_created, n_updated, n_skipped, elapsed_time = import_csv_file(
+                bot, args[0], study, owner, unrecognized_column_callback, unrecognized_value_callback, identifier_column_callback,
+                lambda count: stdout.write(str(count) + '\r'), max_in_flight, diff, journal, date_formats=date_formats,
+                ambiguous_id_callback=ambiguous_id_callback)
+            print('Created ' + str(n_created) + ' patients, updated ' + str(n_updated) + ' patients, and skipped ' + str(n_skipped) + ' unchanged patients.')
+            print('All done! Elapsed time ' + str(elapsed_time))
+    else:
+        #check external IDs
+
+        print('Checking ' + str(len(patients)) + ' external IDs...')
+
+        if max_in_flight:
+            patient_ids = asyncio.run(get_patient_ids_async(async_bot, patients, lambda count: stdout.write(str(count) + '\r'),
+                                                            ambiguous_id_callback))
+        else:
+            patient_ids = get_patient_ids(bot, patients, lambda count: stdout.write(str(count) + '\r'),
+                                          ambiguous_id_callback=ambiguous_id_callback)
 
-    patient_ids = get_patient_ids(bot, patients, lambda count: stdout.write(str(count) + '\r'))
+        #begin import
 
-    #begin import
+        n_to_import, n_to_update, n_left_out = count_rows(patients, patient_ids)
+        summary = 'You are about to import ' + str(n_to_import) + ' new patients and update ' + str(n_to_update) + ' existing patients'
+        if n_left_out:
+            summary += ', leaving out ' + str(n_left_out) + ' rows with ambiguous external IDs'
 
-    n_to_import = str(len(patients) - len(patient_ids))
-    n_to_update = str(len(patient_ids))
+        if yes or input(summary + '. Type y to continue: ')[0] == 'y':
+            if max_in_flight:
+                n_created, n_updated, n_skipped, elapsed_time = asyncio.run(import_patients_async(
+                    async_bot, patients, patient_ids, study, owner, lambda count: stdout.write(str(count) + '\r'), diff, journal))
+            else:
+                n_created, n_updated, n_skipped, elapsed_time = import_patients(
+                    bot, patients, patient_ids, study, owner, lambda count: stdout.write(str(count) + '\r'), diff=diff, journal=journal)
+            print('Created ' + str(n_created) + ' patients, updated ' + str(n_updated) + ' patients, and skipped ' + str(n_skipped) + ' unchanged patients.')
+            print('All done! Elapsed time ' + str(elapsed_time))
 
-    if yes or input('You are about to import ' + n_to_import + ' new patients and update ' + n_to_update + ' existing patients. Type y to continue: ')[0] == 'y':
-        elapsed_time = import_patients(bot, patients, patient_ids, study, owner, lambda count: stdout.write(str(count) + '\r'))
-        print('All done! Elapsed time ' + str(elapsed_time))
+    if journal:
+        journal.close()
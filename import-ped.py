@@ -26,7 +26,6 @@ from datetime import timedelta
 from getopt import getopt
 from getpass import getpass
 from phenotipsbot import PhenoTipsBot
-from requests.exceptions import HTTPError
 from sys import stdout
 
 #parse arguments
@@ -38,9 +37,10 @@ if len(sys.argv) < 2:
 base_url = None
 username = None
 password = None
+index_path = None
 yes = False
 
-optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'yes'])
+optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'index=', 'yes'])
 for name, value in optlist:
     if name == '--base-url':
         base_url = value
@@ -48,6 +48,8 @@ for name, value in optlist:
         username = value
     elif name == '--password':
         password = value
+    elif name == '--index':
+        index_path = value
     elif name in ('-y', '--yes'):
         yes = True
 
@@ -73,33 +75,48 @@ if not password:
 
 #log in
 
-bot = PhenoTipsBot(base_url, username, password)
+bot = PhenoTipsBot(base_url, username, password, index_path=index_path)
+if index_path:
+    print('Updating the external ID index...')
+    bot.refresh_index()
 
 #parse PED file
 #http://pngu.mgh.harvard.edu/~purcell/plink/data.shtml#ped
 
-def get_id(external_id):
-    if external_id == '0':
-        return None
-    try:
-        return bot.get_id(external_id)
-    except HTTPError:
-        return None
-
 print('Matching pedigree rows to the patient database...')
 count = 0
 
 reader = csv.reader(open(args[0], 'r'), delimiter='\t')
+rows = [row for row in reader if len(row) and row[0][0] != '#']
 relatives = []
 
-for row in reader:
-    if len(row) == 0 or row[0][0] == '#':
-        continue
+#resolve every external ID in the file at once instead of up to three requests per row
+external_ids = set()
+for row in rows:
+    external_ids.update(row[1:4])
+external_ids.discard('0')
+patient_ids = bot.resolve_external_ids(sorted(external_ids))
+
+#an external ID that matches several patients cannot say which of them to change, so its rows are left out
+ambiguous_ids = set()
+for external_id, patient_id in patient_ids.items():
+    if type(patient_id) == list:
+        print('WARNING: Leaving out the rows with external ID ' + external_id + ', which matches ' + ', '.join(patient_id))
+        ambiguous_ids.add(external_id)
+
+def get_id(external_id):
+    return patient_ids.get(external_id)
 
+for row in rows:
     child_external_id = row[1]
     father_external_id = row[2]
     mother_external_id = row[3]
 
+    if ambiguous_ids.intersection(row[1:4]):
+        count += 1
+        stdout.write(str(count) + '\r')
+        continue
+
     child_patient_id = get_id(child_external_id)
     father_patient_id = get_id(father_external_id)
     mother_patient_id = get_id(mother_external_id)
@@ -18,42 +18,119 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
 # USA
 
+import hashlib
 import json
+import os
+import queue
 import requests
+import sqlite3
+import sys
+import threading
+import time
+from array import array
 from base64 import b64encode
 from collections import OrderedDict
+from collections import deque
+from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
 from copy import copy
+from copy import deepcopy
+from datetime import datetime
+from itertools import accumulate
 from os.path import basename
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
+from selenium.webdriver.support.ui import WebDriverWait
 from xml.etree import ElementTree
 
 class PhenoTipsBot:
     TIMEOUT = 20 #seconds
+    POOL_SIZE = 10 #connections
+    BULK_CHUNK_SIZE = 100 #patients per query
+    HQL_PAGE_SIZE = 1000 #results per request
+    BROWSERS = 1 #PhantomJS processes
 
-    driver = None
-
-    def __init__(self, base_url, username, password, ssl_verify=True):
+    def __init__(self, base_url, username, password, ssl_verify=True, pool_size=POOL_SIZE, keep_alive=True, index_path=None,
+                 metadata_cache=None, object_cache=None, mirror_path=None, record_type=dict, prefer_json=True, browsers=BROWSERS, reuse_editor=False):
         self.base = base_url
         self.auth = (username, password)
         self.ssl_verify = ssl_verify
+        self.pool_size = pool_size
+        #every request goes through one session so that TCP connections and TLS sessions are reused
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.verify = ssl_verify
+        if not keep_alive:
+            self.session.headers['Connection'] = 'close'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.index = ExternalIdIndex(index_path, base_url) if index_path else None
+        self.metadata_cache = metadata_cache
+        #users may see different studies, users, and groups, so metadata is cached per site and user
+        self.metadata_site = base_url + ' ' + username
+        self.object_cache = object_cache
+        #with a mirror, patients and metadata are read from the local database instead of the server
+        self.mirror = SiteMirror(mirror_path, base_url) if mirror_path else None
+        #objects are returned as this type, e.g. CompactRecord to hold many of them at once
+        self.record_type = record_type
+        self.prefer_json = prefer_json
+        self.page_objects = None #whether the server includes objects in pages, once a request has shown it
+        self.class_properties = {} #class name -> properties, read once for comparing values in update_object
+        #pedigree operations borrow a browser from the pool, so up to that many of them can run at once
+        self.browser_pool = BrowserPool(self.auth, browsers, base_url + '/bin/view/PhenoTips/PedigreeEditor')
+        #records how long each step of create and of the pedigree operations takes
+        self.timer = StepTimer()
+        self.reuse_editor = reuse_editor
 
-    def create(self, patient_obj=None, study=None, owner=None, pedigree=None):
-        r = requests.post(self.base + '/rest/patients', auth=self.auth, verify=self.ssl_verify)
-        r.raise_for_status()
-        patient_id = r.headers['location']
-        patient_id = patient_id[patient_id.rfind('/')+1:]
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.browser_pool.close()
+        if self.index:
+            self.index.close()
+        if self.mirror:
+            self.mirror.close()
+        if self.object_cache:
+            self.object_cache.save()
+        self.session.close()
+
+    def create(self, patient_obj=None, study=None, owner=None, pedigree=None, journal=None, journal_key=None):
+        #every step saves the same document, so they are run one after another rather than overlapped
+        patient_id = journal.get(journal_key) if journal else None
+        resumed = patient_id != None
+        if not resumed:
+            r = self.timer.timed('create patient', self.session.post, self.base + '/rest/patients')
+            r.raise_for_status()
+            patient_id = r.headers['location']
+            patient_id = patient_id[patient_id.rfind('/')+1:]
+            if journal:
+                journal.put(journal_key, patient_id)
         if patient_obj:
-            self.set(patient_id, patient_obj)
-        if study:
-            self.set_study(patient_id, study)
-        if owner:
-            self.set_owner(patient_id, owner)
+            self.timer.timed('set properties', self.set, patient_id, patient_obj)
+        if study and resumed:
+            #the page was created by a run that stopped partway, so it may already have a study binding
+            self.timer.timed('set study', self.set_study, patient_id, study)
+        elif study:
+            #a new patient has no study binding yet, so there is no need to look for one
+            self.timer.timed('set study', self.create_object, patient_id, 'PhenoTips.StudyBindingClass',
+                             {'studyReference': PhenoTipsBot.qualify(study, 'Studies')})
+        if owner and PhenoTipsBot.qualify(owner) != PhenoTipsBot.qualify(self.auth[0]):
+            #PhenoTips already makes the user who creates a patient its owner
+            self.timer.timed('set owner', self.set_owner, patient_id, owner)
         if pedigree:
-            self.set_pedigree(patient_id, pedigree)
+            self.timer.timed('set pedigree', self.set_pedigree, patient_id, pedigree)
         #the mandatory PhenoTips.VCF object is not added until someone visits the edit page
         url = self.base + '/bin/edit/data/' + patient_id
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify);
+        r = self.timer.timed('visit edit page', self.session.get, url)
         r.raise_for_status()
+        self.invalidate_cache(patient_id)
         return patient_id
 
     def create_collaborator(self, patient_id, collaborator_obj):
@@ -62,13 +139,17 @@ class PhenoTipsBot:
             collaborator_obj['collaborator'] = PhenoTipsBot.qualify(collaborator_obj['collaborator'])
         return self.create_object(self, patient_id, 'PhenoTips.CollaboratorClass', collaborator_obj)
 
+    def create_many(self, patient_objs, study=None, owner=None, workers=None, ordered=True):
+        return self.map_batch(lambda patient_obj: self.create(patient_obj, study, owner), patient_objs, workers, ordered)
+
     def create_object(self, patient_id, object_class, object_obj):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects'
         data = {'className': object_class}
         for key, value in object_obj.items():
             data['property#' + key] = value
-        r = requests.post(url, auth=self.auth, data=data, verify=self.ssl_verify)
+        r = self.session.post(url, data=data)
         r.raise_for_status()
+        self.invalidate_cache(patient_id)
         object_number = r.headers['location']
         object_number = object_number[object_number.rfind('/')+1:]
         return object_number
@@ -80,21 +161,25 @@ class PhenoTipsBot:
         return self.create_object(patient_id, 'PhenoTips.VCF', vcf_obj)
 
     def delete(self, patient_id):
-        r = requests.delete(self.base + '/rest/patients/' + patient_id, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.delete(self.base + '/rest/patients/' + patient_id)
         r.raise_for_status()
+        self.invalidate_cache(patient_id)
+        if self.index:
+            self.index.remove(patient_id)
 
     def delete_collaborator(self, patient_id, collaborator_num):
         self.delete_object(patient_id, 'PhenoTips.CollaboratorClass', collaborator_num)
 
     def delete_file(self, patient_id, filename):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/attachments/' + filename
-        r = requests.delete(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.delete(url)
         r.raise_for_status()
 
     def delete_object(self, patient_id, object_class, object_num):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class + '/' + relative_num
-        r = requests.delete(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.delete(url)
         r.raise_for_status()
+        self.invalidate_cache(patient_id)
 
     def delete_relative(self, patient_id, relative_num):
         self.delete_object(patient_id, 'PhenoTips.RelativeClass', relative_num)
@@ -108,15 +193,88 @@ class PhenoTipsBot:
         fd.close()
 
     def export_pedigree_ped(self, patient_id, id_generation='external'):
-        self.init_phantom()
-        url = self.base + '/bin/' + patient_id + '?sheet=PhenoTips.PedigreeEditor'
-        self.driver.get(url)
-        self.driver.find_element_by_css_selector('#canvas svg') #wait for the page to load
-        return self.driver.execute_script('return window.PedigreeExport.exportAsPED(window.editor.getGraph().DG, ' + json.dumps(id_generation) + ');')
+        def export(driver):
+            if not self.open_pedigree_editor(driver, patient_id):
+                data = json.dumps(self.get_object(patient_id, 'PhenoTips.PedigreeClass', '0')['data'])
+                self.timer.timed('set graph', driver.execute_script, 'window.editor.getSaveLoadEngine().createGraphFromSerializedData(' + data + ');')
+            return self.timer.timed('export', driver.execute_script, 'return window.PedigreeExport.exportAsPED(window.editor.getGraph().DG, ' + json.dumps(id_generation) + ');')
+
+        return self.browser_pool.run(export)
 
     def get(self, patient_id):
         return self.get_object(patient_id, 'PhenoTips.PatientClass', '0')
 
+    def get_all_objects(self, patient_id, classes=None):
+        #XWiki 7.3 and later return every object on the page with its properties in one request; on older servers one
+        #request lists the objects and then they are downloaded in parallel over the connection pool
+        if self.mirror:
+            ret = self.mirror.get_all_objects(patient_id, classes)
+            for object_objs in ret.values():
+                for object_num, object_obj in object_objs.items():
+                    object_objs[object_num] = self.make_record(object_obj)
+            return ret
+        ret = OrderedDict((object_class, OrderedDict()) for object_class in classes or [])
+        if self.page_objects != False:
+            if self.object_cache and not self.object_cache.is_validated(patient_id):
+                self.validate_cache([patient_id]) #so that the objects can be cached along with the page's date
+            objects = self.get_page_objects(patient_id)
+            self.page_objects = objects != None
+            if objects != None:
+                for object_class, object_num, object_obj in objects:
+                    if classes == None or object_class in classes:
+                        if self.object_cache:
+                            self.object_cache.put((patient_id, object_class, object_num), object_obj)
+                        ret.setdefault(object_class, OrderedDict())[object_num] = self.make_record(object_obj)
+                return ret
+        url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects'
+        keys = []
+        for summary in self.iter_elements(url, '{http://www.xwiki.org}objectSummary', json_key='objectSummaries'):
+            if type(summary) == dict:
+                object_class = summary['className']
+                object_num = str(summary['number'])
+            else:
+                object_class = summary.find('{http://www.xwiki.org}className').text
+                object_num = summary.find('{http://www.xwiki.org}number').text
+            if classes == None or object_class in classes:
+                keys.append((object_class, object_num))
+        if keys and self.object_cache and not self.object_cache.is_validated(patient_id):
+            self.validate_cache([patient_id]) #once for the page instead of once for each object
+        for key, object_obj, error in self.map_batch(lambda key: self.get_object(patient_id, key[0], key[1]), keys, self.pool_size):
+            if error:
+                raise error
+            ret.setdefault(key[0], OrderedDict())[key[1]] = object_obj
+        return ret
+
+    def get_bulk(self, patient_ids, object_class='PhenoTips.PatientClass', chunk_size=BULK_CHUNK_SIZE):
+        #one query per chunk returns the first object of the class on every page in the chunk
+        if self.mirror:
+            return OrderedDict((patient_id, self.make_record(object_obj)) for patient_id, object_obj in self.mirror.get_bulk(patient_ids, object_class).items())
+        patient_ids = list(patient_ids)
+        found = {}
+        for start in range(0, len(patient_ids), chunk_size):
+            chunk = patient_ids[start:start + chunk_size]
+            if self.object_cache:
+                #check the modification dates of the whole chunk at once and only download the changed pages
+                self.validate_cache(chunk)
+                for patient_id in chunk:
+                    object_obj = self.object_cache.get((patient_id, object_class, None))
+                    if object_obj != None:
+                        found[patient_id] = self.make_record(object_obj)
+                chunk = [patient_id for patient_id in chunk if patient_id not in found]
+                if not chunk:
+                    continue
+            query = "where doc.fullName in (" + ', '.join(PhenoTipsBot.quote('data.' + patient_id) for patient_id in chunk) + ")"
+            for pagename, object_obj in self.list_hql_objects(query, object_class):
+                patient_id = PhenoTipsBot.unqualify(pagename, 'data')
+                if self.object_cache:
+                    self.object_cache.put((patient_id, object_class, None), object_obj)
+                found[patient_id] = self.make_record(object_obj)
+        ret = OrderedDict()
+        for patient_id in patient_ids:
+            if patient_id in found:
+                ret[patient_id] = found[patient_id]
+        return ret
+
     def get_collaborator(self, patient_id, collaborator_num):
         ret = self.get_object(patient_id, 'PhenoTips.CollaboratorClass', collaborator_num)
         ret['collaborator'] = PhenoTipsBot.unqualify(ret['collaborator'])
@@ -124,19 +282,28 @@ class PhenoTipsBot:
 
     def get_file(self, patient_id, filename):
         url = self.base + '/bin/download/data/' + patient_id + '/' + filename
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url)
         r.raise_for_status()
         return r.content
 
     def get_id(self, external_id):
+        if self.mirror:
+            return self.mirror.get_id(external_id)
+        if self.index:
+            patient_id = self.index.get(external_id)
+            if patient_id:
+                return patient_id
         url = self.base + '/rest/patients/eid/' + external_id
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url)
         if r.status_code == 404:
             return None
         r.raise_for_status()
         content_type = r.headers['content-type'].split(';')[0]
         if content_type == 'application/json':
-            return json.loads(r.text)['id']
+            patient_id = json.loads(r.text)['id']
+            if self.index:
+                self.index.put(patient_id, external_id)
+            return patient_id
         elif content_type == 'application/xml':
             root = ElementTree.fromstring(r.text)
             id_elements = root.findall('./{http://www.xwiki.org}alternatives/{http://www.xwiki.org}patient/{http://www.xwiki.org}id')
@@ -144,19 +311,65 @@ class PhenoTipsBot:
         else:
             raise TypeError('Expected JSON or XML')
 
+    def get_many(self, patient_ids, workers=None, ordered=True):
+        return self.map_batch(self.get, patient_ids, workers, ordered)
+
     def get_object(self, patient_id, object_class, object_num):
+        if self.mirror:
+            return self.make_record(self.mirror.get_object(patient_id, object_class, object_num))
+        key = (patient_id, object_class, object_num)
+        if self.object_cache:
+            #a cached object is only used if the page has not been modified since it was downloaded, and the page's
+            #date is recorded before a download so that the object can be revalidated without downloading it again
+            if not self.object_cache.is_validated(patient_id):
+                self.validate_cache([patient_id])
+            ret = self.object_cache.get(key)
+            if ret != None:
+                return self.make_record(ret)
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class + '/' + object_num
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
-        r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
         ret = {}
-        for prop in root.iter('{http://www.xwiki.org}property'):
-            ret[prop.attrib['name']] = prop.find('{http://www.xwiki.org}value').text
-        return ret
+        for prop in self.iter_elements(url, '{http://www.xwiki.org}property', json_key='properties'):
+            if type(prop) == dict:
+                ret[prop['name']] = prop.get('value') or None #XML gives None for empty values
+            else:
+                ret[prop.attrib['name']] = prop.find('{http://www.xwiki.org}value').text
+        if self.object_cache:
+            self.object_cache.put(key, ret)
+        return self.make_record(ret)
 
     def get_owner(self, patient_id):
         return PhenoTipsBot.unqualify(self.get_object(patient_id, 'PhenoTips.OwnerClass', '0')['owner'])
 
+    def get_page_objects(self, patient_id):
+        #returns (class, number, properties) for every object on the page, or None if the server leaves the objects out
+        #of the page because it is older than XWiki 7.3
+        url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id
+        headers = {'Accept': 'application/json, application/xml;q=0.9'} if self.prefer_json else {}
+        r = self.session.get(url, params={'objects': 'true'}, headers=headers)
+        r.raise_for_status()
+        ret = []
+        if r.headers.get('content-type', '').split(';')[0] == 'application/json':
+            objects = r.json().get('objects')
+            if objects == None:
+                return None
+            for summary in objects.get('objectSummaries', []):
+                if 'properties' not in summary:
+                    return None
+                object_obj = {}
+                for prop in summary['properties']:
+                    object_obj[prop['name']] = prop.get('value') or None #XML gives None for empty values
+                ret.append((summary['className'], str(summary['number']), object_obj))
+        else:
+            objects_el = ElementTree.fromstring(r.content).find('{http://www.xwiki.org}objects')
+            if objects_el == None:
+                return None
+            for summary in objects_el.findall('{http://www.xwiki.org}objectSummary'):
+                if summary.find('{http://www.xwiki.org}property') == None:
+                    return None
+                ret.append((summary.find('{http://www.xwiki.org}className').text, summary.find('{http://www.xwiki.org}number').text,
+                            PhenoTipsBot.parse_properties(summary)))
+        return ret
+
     def get_pedigree(self, patient_id):
         return json.loads(self.get_object(patient_id, 'PhenoTips.PedigreeClass', '0')['data'])
 
@@ -164,8 +377,15 @@ class PhenoTipsBot:
         return self.get_object(patient_id, 'PhenoTips.RelativeClass', relative_num)
 
     def get_study(self, patient_id):
+        if self.mirror:
+            study_obj = self.mirror.get_bulk([patient_id], 'PhenoTips.StudyBindingClass').get(patient_id)
+            if study_obj == None:
+                return None
+            if not study_obj.get('studyReference'):
+                return ''
+            return PhenoTipsBot.unqualify(study_obj['studyReference'], 'Studies')
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/PhenoTips.StudyBindingClass/0'
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url)
         if r.status_code == 404:
             return None
         else:
@@ -181,70 +401,106 @@ class PhenoTipsBot:
         return self.get_object(patient_id, 'PhenoTips.VCF', vcf_num)
 
     def import_pedigree_ped(self, patient_id, pedigree_str, mark_evaluated=False, external_id_mark=True, accept_unknown_phenotypes=True):
-        self.init_phantom()
-        url = self.base + '/bin/' + patient_id + '?sheet=PhenoTips.PedigreeEditor'
         data = json.dumps(pedigree_str)
         import_options = json.dumps({
             'markEvaluated': mark_evaluated,
             'externalIdMark': external_id_mark,
             'acceptUnknownPhenotypes': accept_unknown_phenotypes
         })
-        self.driver.get(url)
-        self.driver.find_element_by_css_selector('#canvas svg') #wait for the page to load
-        self.driver.execute_script('window.editor.getSaveLoadEngine().createGraphFromImportData(' + data + ', "ped", ' + import_options + ');')
-        self.driver.execute_script('window.editor.getSaveLoadEngine().save();')
-        self.driver.find_element_by_css_selector('#action-save.menu-item') #wait for the image to be saved
+
+        def import_ped(driver):
+            self.open_pedigree_editor(driver, patient_id)
+            self.timer.timed('set graph', driver.execute_script, 'window.editor.getSaveLoadEngine().createGraphFromImportData(' + data + ', "ped", ' + import_options + ');')
+            self.save_pedigree_editor(driver)
+
+        self.browser_pool.run(import_ped)
+        self.invalidate_cache(patient_id)
 
     def init_phantom(self):
-        if not self.driver:
-            authorization = 'Basic ' + b64encode((self.auth[0] + ':' + self.auth[1]).encode('utf-8')).decode('utf-8')
-            webdriver.DesiredCapabilities.PHANTOMJS['phantomjs.page.customHeaders.authorization'] = authorization
-            self.driver = webdriver.PhantomJS()
-            self.driver.set_window_size(1920, 1080) #big enough to not cut off any elements
-            self.driver.implicitly_wait(PhenoTipsBot.TIMEOUT)
-
-    def list(self, study=None, owner=None, having_object=None):
-        query = ", BaseObject as obj"
-        if study != None:
-            query += ", BaseObject as study_obj, StringProperty as study_prop"
-        if owner:
-            query += ", BaseObject as owner_obj, StringProperty as owner_prop"
-        if having_object:
-            query += ", BaseObject as needful_obj"
-        query += " where doc.space = 'data' and doc.fullName = obj.name and obj.className = 'PhenoTips.PatientClass'"
-        if having_object:
-            query += " and doc.fullName = needful_obj.name and needful_obj.className = '" + having_object + "'"
-        if study != None:
-            query += " and doc.fullName = study_obj.name and study_obj.className = 'PhenoTips.StudyBindingClass'"
-            query += " and study_obj.id = study_prop.id.id and study_prop.id.name = 'studyReference'"
-            query += " and study_prop.value = 'xwiki:Studies." + study + "'"
-        if owner:
-            query += " and doc.fullName = owner_obj.name and owner_obj.className = 'PhenoTips.OwnerClass'"
-            query += " and owner_obj.id = owner_prop.id.id and owner_prop.id.name = 'owner'"
-            query += " and owner_prop.value = '" + PhenoTipsBot.qualify(owner) + "'"
-        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, 'data'), self.list_hql(query)))
+        #starts every browser in the pool now instead of when the first pedigree operations need them
+        self.browser_pool.start()
+
+    def invalidate_cache(self, patient_id):
+        if self.object_cache:
+            self.object_cache.invalidate(patient_id)
+
+    def iter_elements(self, url, tag, params=None, json_key=None):
+        #parses the response as it arrives instead of downloading it first
+        #if json_key is given, JSON is requested and the dictionaries listed under that key are yielded if the server sends it
+        headers = {'Accept': 'application/json, application/xml;q=0.9'} if json_key and self.prefer_json else {}
+        with self.session.get(url, params=params, headers=headers, stream=True) as r:
+            r.raise_for_status()
+            if r.headers.get('content-type', '').split(';')[0] == 'application/json':
+                yield from r.json()[json_key]
+                return
+            r.raw.decode_content = True #undo any gzip encoding
+            yield from PhenoTipsBot.parse_elements(r.raw, tag)
+
+    def iter_hql(self, query, page_size=HQL_PAGE_SIZE):
+        #pages through the results with the query resource's number and start parameters
+        if ' order by ' not in query:
+            query += ' order by doc.fullName' #so that the pages do not overlap
+        url = self.base + '/rest/wikis/xwiki/query'
+
+        def fetch(start):
+            params = {'q': query, 'type': 'hql', 'number': page_size, 'start': start}
+            results = self.iter_elements(url, '{http://www.xwiki.org}searchResult', params, 'searchResults')
+            return list(map(PhenoTipsBot.result_id, results))
+
+        #the next page is downloaded while the caller works on the current one
+        with ThreadPoolExecutor(1) as executor:
+            start = 0
+            future = executor.submit(fetch, start)
+            while future:
+                pagenames = future.result()
+                start += page_size
+                future = executor.submit(fetch, start) if len(pagenames) == page_size else None
+                yield from pagenames
+
+    def iter_list(self, study=None, owner=None, having_object=None, since=None, page_size=HQL_PAGE_SIZE):
+        if self.mirror:
+            yield from self.mirror.list(study, owner, having_object, since)
+            return
+        for pagename in self.iter_hql(PhenoTipsBot.patient_query(study, owner, having_object, since), page_size):
+            yield PhenoTipsBot.unqualify(pagename, 'data')
+
+    def iter_pages(self, space, having_object=None, page_size=HQL_PAGE_SIZE):
+        for pagename in self.iter_hql(PhenoTipsBot.pages_query(space, having_object), page_size):
+            yield PhenoTipsBot.unqualify(pagename, space)
+
+    def list(self, study=None, owner=None, having_object=None, since=None):
+        if self.mirror:
+            return self.mirror.list(study, owner, having_object, since)
+        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, 'data'), self.list_hql(PhenoTipsBot.patient_query(study, owner, having_object, since))))
 
     def list_class_properties(self, class_name):
+        key = 'class_properties/' + class_name
+        if self.mirror:
+            return self.mirror.get_metadata(key)
+        if self.metadata_cache:
+            ret = self.metadata_cache.get(self.metadata_site, key)
+            if ret != None:
+                return ret
         url = self.base + '/rest/wikis/xwiki/classes/' + class_name
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
-        r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
         ret = OrderedDict()
-        for prop in root.iter('{http://www.xwiki.org}property'):
-            prop_name = prop.attrib['name']
-            ret[prop_name] = {'type': prop.attrib['type']}
-
-            number_type_el = prop.find('./{http://www.xwiki.org}attribute[@name="numberType"]')
-            regex_el = prop.find('./{http://www.xwiki.org}attribute[@name="validationRegExp"]')
-            values_el = prop.find('./{http://www.xwiki.org}attribute[@name="values"]')
-
-            if number_type_el != None:
-                ret[prop_name]['numberType'] = number_type_el.attrib['value']
-            if regex_el != None:
-                ret[prop_name]['validationRegExp'] = regex_el.attrib['value']
-            if values_el != None:
+        for prop in self.iter_elements(url, '{http://www.xwiki.org}property', json_key='properties'):
+            if type(prop) == dict:
+                prop_name = prop['name']
+                prop_type = prop['type']
+                attributes = {attribute['name']: attribute['value'] for attribute in prop.get('attributes', [])}
+            else:
+                prop_name = prop.attrib['name']
+                prop_type = prop.attrib['type']
+                attributes = {el.attrib['name']: el.attrib['value'] for el in prop.findall('./{http://www.xwiki.org}attribute')}
+            ret[prop_name] = {'type': prop_type}
+
+            if 'numberType' in attributes:
+                ret[prop_name]['numberType'] = attributes['numberType']
+            if 'validationRegExp' in attributes:
+                ret[prop_name]['validationRegExp'] = attributes['validationRegExp']
+            if 'values' in attributes:
                 ret[prop_name]['values'] = {}
-                for key_value_pair in values_el.attrib['value'].split('|'):
+                for key_value_pair in attributes['values'].split('|'):
                     key_value_pair = key_value_pair.split('=')
                     if len(key_value_pair) > 1:
                         key = key_value_pair[0]
@@ -252,6 +508,8 @@ class PhenoTipsBot:
                     else:
                         key = value = key_value_pair[0]
                     ret[prop_name]['values'][key] = value
+        if self.metadata_cache:
+            self.metadata_cache.put(self.metadata_site, 'class_properties/' + class_name, ret)
         return ret
 
     def list_collaborators(self, patient_id):
@@ -262,25 +520,66 @@ class PhenoTipsBot:
 
     def list_hql(self, query):
         url = self.base + '/rest/wikis/xwiki/query'
-        r = requests.get(url, params={'q': query, 'type': 'hql'}, auth=self.auth, verify=self.ssl_verify)
-        r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
-        id_elements = root.findall('./{http://www.xwiki.org}searchResult/{http://www.xwiki.org}id')
-        return list(map(lambda el: el.text, id_elements))
+        results = self.iter_elements(url, '{http://www.xwiki.org}searchResult', {'q': query, 'type': 'hql'}, 'searchResults')
+        return list(map(PhenoTipsBot.result_id, results))
+
+    def list_hql_objects(self, query, object_class):
+        url = self.base + '/rest/wikis/xwiki/query'
+        ret = []
+        for result in self.iter_elements(url, '{http://www.xwiki.org}searchResult', {'q': query, 'type': 'hql', 'className': object_class}):
+            object_el = result.find('./{http://www.xwiki.org}object')
+            if object_el != None:
+                ret.append((result.find('./{http://www.xwiki.org}id').text, PhenoTipsBot.parse_properties(object_el)))
+        return ret
 
     def list_objects(self, patient_id, object_class):
+        if self.mirror:
+            return self.mirror.list_objects(patient_id, object_class)
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
-        r.raise_for_status()
-        root = ElementTree.fromstring(r.text)
-        number_elements = root.findall('./{http://www.xwiki.org}objectSummary/{http://www.xwiki.org}number')
-        return list(map(lambda el: el.text, number_elements))
+        ret = []
+        for summary in self.iter_elements(url, '{http://www.xwiki.org}objectSummary', json_key='objectSummaries'):
+            if type(summary) == dict:
+                ret.append(str(summary['number']))
+            else:
+                ret.append(summary.find('{http://www.xwiki.org}number').text)
+        return ret
+
+    def list_patient_dates(self, since=None, patient_ids=None, chunk_size=BULK_CHUNK_SIZE):
+        #returns the patient pages modified at or after since, oldest first, with their modification dates
+        if self.mirror:
+            return self.mirror.list_patient_dates(since, patient_ids)
+        query = ", BaseObject as obj where doc.space = 'data' and doc.fullName = obj.name and obj.className = 'PhenoTips.PatientClass'"
+        if since:
+            query += " and doc.date >= " + PhenoTipsBot.quote(since)
+        queries = [query]
+        if patient_ids != None:
+            patient_ids = list(patient_ids)
+            queries = []
+            for start in range(0, len(patient_ids), chunk_size):
+                chunk = patient_ids[start:start + chunk_size]
+                queries.append(query + " and doc.fullName in (" + ', '.join(PhenoTipsBot.quote('data.' + patient_id) for patient_id in chunk) + ")")
+        url = self.base + '/rest/wikis/xwiki/query'
+        ret = OrderedDict()
+        for query in queries:
+            for result in self.iter_elements(url, '{http://www.xwiki.org}searchResult', {'q': query + " order by doc.date", 'type': 'hql'}):
+                pagename = result.find('./{http://www.xwiki.org}id').text
+                modified = result.find('./{http://www.xwiki.org}modified').text
+                #the REST API gives the date in the server's time zone, which is also how it is stored in the database
+                ret[PhenoTipsBot.unqualify(pagename, 'data')] = modified[:19].replace('T', ' ')
+        return ret
 
     def list_pages(self, space, having_object=None):
-        query = ", BaseObject as obj where doc.space = '" + space + "'"
-        if having_object:
-            query += " and doc.fullName = obj.name and obj.className = '" + having_object + "'"
-        return list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, space), self.list_hql(query)))
+        key = 'pages/' + space + '/' + (having_object or '')
+        if self.mirror:
+            return self.mirror.get_metadata(key)
+        if self.metadata_cache:
+            ret = self.metadata_cache.get(self.metadata_site, key)
+            if ret != None:
+                return ret
+        ret = list(map(lambda pagename: PhenoTipsBot.unqualify(pagename, space), self.list_hql(PhenoTipsBot.pages_query(space, having_object))))
+        if self.metadata_cache:
+            self.metadata_cache.put(self.metadata_site, key, ret)
+        return ret
 
     def list_patient_class_properties(self):
         return self.list_class_properties('PhenoTips.PatientClass')
@@ -297,6 +596,123 @@ class PhenoTipsBot:
     def list_vcfs(self, patient_id):
         return self.list_objects(patient_id, 'PhenoTips.VCF')
 
+    def make_record(self, object_obj):
+        return object_obj if self.record_type == dict else self.record_type(object_obj)
+
+    def map_batch(self, function, items, workers=None, ordered=True, key=None, depth=None):
+        #yields an (item, result, error) tuple for each item, either in input order or as the items finish
+        #items with the same non-None key are run one after another in input order
+        workers = workers or self.pool_size
+        depth = depth or workers * 2
+
+        def call(item, previous):
+            if previous:
+                wait([previous])
+            try:
+                return item, function(item), None
+            except Exception as err:
+                return item, None, err
+
+        with ThreadPoolExecutor(workers) as executor:
+            pending = deque() if ordered else set()
+            last_futures = {}
+
+            def finish(future):
+                item = future.result()[0]
+                item_key = key(item) if key else None
+                if item_key != None and last_futures.get(item_key) is future:
+                    del last_futures[item_key]
+                return future.result()
+
+            def drain(limit):
+                while len(pending) > limit:
+                    if ordered:
+                        yield finish(pending.popleft())
+                    else:
+                        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            pending.remove(future)
+                            yield finish(future)
+
+            for item in items:
+                item_key = key(item) if key else None
+                future = executor.submit(call, item, last_futures.get(item_key))
+                if item_key != None:
+                    last_futures[item_key] = future
+                if ordered:
+                    pending.append(future)
+                else:
+                    pending.add(future)
+                #keep a bounded number of items in flight so that huge iterables are not read all at once; in order, the
+                #finished items behind a slow one wait here, so this also bounds the reorder buffer
+                yield from drain(depth)
+
+            yield from drain(0)
+
+    def open_pedigree_editor(self, driver, patient_id):
+        #returns False if the editor was switched to the patient in place, in which case it still shows the previous graph
+        if self.reuse_editor and driver.execute_script(BrowserPool.EDITOR_READY_SCRIPT):
+            self.timer.timed('switch patient', driver.execute_script, BrowserPool.SWITCH_PATIENT_SCRIPT, patient_id)
+            return False
+        self.timer.timed('load editor', driver.get, self.base + '/bin/' + patient_id + '?sheet=PhenoTips.PedigreeEditor')
+        self.timer.timed('wait for editor', self.browser_pool.wait_for, driver, BrowserPool.EDITOR_READY_SCRIPT)
+        return True
+
+    def refresh_index(self):
+        #only the patients modified since the last refresh are downloaded again
+        since = self.index.get_synced()
+        dates = self.list_patient_dates(since)
+        patient_ids = list(dates)
+        for start in range(0, len(patient_ids), PhenoTipsBot.BULK_CHUNK_SIZE):
+            #one chunk of patients is held at a time
+            chunk = patient_ids[start:start + PhenoTipsBot.BULK_CHUNK_SIZE]
+            patients = self.get_bulk(chunk)
+            self.index.put_many((patient_id, patients.get(patient_id, {}).get('external_id')) for patient_id in chunk)
+        self.index.retain(self.list())
+        if dates:
+            self.index.set_synced(max(dates.values()))
+
+    def resolve_external_ids(self, external_ids, chunk_size=BULK_CHUNK_SIZE):
+        #like get_id for many external IDs at once: None if no patient matches, a list if several do
+        if self.mirror:
+            return OrderedDict((external_id, self.mirror.get_id(external_id)) for external_id in external_ids)
+        external_ids = list(external_ids)
+        found = {}
+        unknown_ids = external_ids
+        if self.index:
+            unknown_ids = []
+            for external_id in external_ids:
+                patient_id = self.index.get(external_id)
+                if patient_id:
+                    found[external_id] = patient_id if type(patient_id) == list else [patient_id]
+                else:
+                    unknown_ids.append(external_id)
+        for start in range(0, len(unknown_ids), chunk_size):
+            chunk = unknown_ids[start:start + chunk_size]
+            query = ", BaseObject as obj, StringProperty as eid_prop"
+            query += " where doc.space = 'data' and doc.fullName = obj.name and obj.className = 'PhenoTips.PatientClass'"
+            query += " and obj.id = eid_prop.id.id and eid_prop.id.name = 'external_id'"
+            query += " and eid_prop.value in (" + ', '.join(map(PhenoTipsBot.quote, chunk)) + ")"
+            for pagename, patient_obj in self.list_hql_objects(query, 'PhenoTips.PatientClass'):
+                patient_id = PhenoTipsBot.unqualify(pagename, 'data')
+                found.setdefault(patient_obj['external_id'], []).append(patient_id)
+                if self.index:
+                    self.index.put(patient_id, patient_obj['external_id'])
+        ret = OrderedDict()
+        for external_id in external_ids:
+            patient_ids = found.get(external_id)
+            if not patient_ids:
+                ret[external_id] = None
+            elif len(patient_ids) == 1:
+                ret[external_id] = patient_ids[0]
+            else:
+                ret[external_id] = patient_ids
+        return ret
+
+    def save_pedigree_editor(self, driver):
+        self.timer.timed('save', driver.execute_script, 'window.editor.getSaveLoadEngine().save();')
+        self.timer.timed('wait for save', self.browser_pool.wait_for, driver, BrowserPool.SAVE_DONE_SCRIPT)
+
     def set(self, patient_id, patient_obj):
         self.set_object(patient_id, 'PhenoTips.PatientClass', '0', patient_obj)
 
@@ -308,16 +724,23 @@ class PhenoTipsBot:
 
     def set_file(self, patient_id, filename, contents):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/attachments/' + filename
-        r = requests.put(url, auth=self.auth, data=contents, verify=self.ssl_verify)
+        r = self.session.put(url, data=contents)
         r.raise_for_status()
 
+    def set_many(self, patients, workers=None, ordered=True):
+        #patients is an iterable of (patient_id, patient_obj) pairs; updates to the same patient are applied in order
+        return self.map_batch(lambda patient: self.set(*patient), patients, workers, ordered, key=lambda patient: patient[0])
+
     def set_object(self, patient_id, object_class, object_num, object_obj):
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/' + object_class + '/' + object_num
         data = {}
         for key, value in object_obj.items():
             data['property#' + key] = value
-        r = requests.put(url, auth=self.auth, data=data, verify=self.ssl_verify)
+        r = self.session.put(url, data=data)
         r.raise_for_status()
+        self.invalidate_cache(patient_id)
+        if self.index and object_class == 'PhenoTips.PatientClass' and 'external_id' in object_obj:
+            self.index.put(patient_id, object_obj['external_id'])
 
     def set_owner(self, patient_id, owner):
         owner_name = PhenoTipsBot.qualify(owner)
@@ -325,21 +748,23 @@ class PhenoTipsBot:
 
     def set_pedigree(self, patient_id, pedigree_obj):
         #the SVG is not automatically updated if the JSON is changed via the REST API
-        self.init_phantom()
-        url = self.base + '/bin/' + patient_id + '?sheet=PhenoTips.PedigreeEditor'
         data = json.dumps(json.dumps(pedigree_obj, sort_keys=True))
-        self.driver.get(url)
-        self.driver.find_element_by_css_selector('#canvas svg') #wait for the page to load
-        self.driver.execute_script('window.editor.getSaveLoadEngine().createGraphFromSerializedData(' + data + ');')
-        self.driver.execute_script('window.editor.getSaveLoadEngine().save();')
-        self.driver.find_element_by_css_selector('#action-save.menu-item') #wait for the image to be saved
+
+        def set_graph(driver):
+            self.open_pedigree_editor(driver, patient_id)
+            self.timer.timed('set graph', driver.execute_script, 'window.editor.getSaveLoadEngine().createGraphFromSerializedData(' + data + ');')
+            self.save_pedigree_editor(driver)
+
+        self.browser_pool.run(set_graph)
+        self.invalidate_cache(patient_id)
 
     def set_relative(self, patient_id, relative_num, relative_obj):
         self.set_object(patient_id, 'PhenoTips.RelativeClass', relative_num, relative_obj)
 
     def set_study(self, patient_id, study):
+        self.invalidate_cache(patient_id)
         url = self.base + '/rest/wikis/xwiki/spaces/data/pages/' + patient_id + '/objects/PhenoTips.StudyBindingClass/0'
-        r = requests.get(url, auth=self.auth, verify=self.ssl_verify)
+        r = self.session.get(url)
         if r.status_code == 404:
             if study == None:
                 return
@@ -349,21 +774,118 @@ class PhenoTipsBot:
         else:
             r.raise_for_status()
             if study == None:
-                requests.delete(url, auth=self.auth, verify=self.ssl_verify)
+                self.session.delete(url)
                 r.raise_for_status()
             else:
                 data = {'property#studyReference': PhenoTipsBot.qualify(study, 'Studies')}
-                r = requests.put(url, auth=self.auth, data=data, verify=self.ssl_verify)
+                r = self.session.put(url, data=data)
                 r.raise_for_status()
 
     def set_vcf(self, patient_id, vcf_num, vcf_obj):
         self.set_object(patient_id, 'PhenoTips.VCF', vcf_num, vcf_obj)
 
+    def update(self, patient_id, patient_obj, current_obj=None):
+        return self.update_object(patient_id, 'PhenoTips.PatientClass', '0', patient_obj, current_obj)
+
+    def update_object(self, patient_id, object_class, object_num, object_obj, current_obj=None):
+        #returns the properties that were sent, which is empty if nothing changed and no request was made
+        if current_obj == None:
+            current_obj = self.get_object(patient_id, object_class, object_num)
+        if object_class not in self.class_properties:
+            self.class_properties[object_class] = self.list_class_properties(object_class)
+        changes = PhenoTipsBot.changed_properties(current_obj, object_obj, self.class_properties[object_class])
+        if changes:
+            self.set_object(patient_id, object_class, object_num, changes)
+        return changes
+
     def upload_file(self, patient_id, filepath):
         fd = open(filepath, "rb")
         self.set_file(patient_id, basename(filepath), fd.read())
         fd.close()
 
+    def validate_cache(self, patient_ids):
+        #one date query per chunk of pages decides which cached objects are still current
+        if self.mirror:
+            return
+        dates = self.list_patient_dates(patient_ids=patient_ids)
+        for patient_id in patient_ids:
+            self.object_cache.validate(patient_id, dates.get(patient_id))
+
+    def changed_properties(current_obj, object_obj, class_properties=None):
+        #the server returns every value as a string, and None for an empty one
+        changes = OrderedDict()
+        for key, value in object_obj.items():
+            property_metadata = class_properties.get(key) if class_properties else None
+            new_value = PhenoTipsBot.normalize_value(value, property_metadata)
+            if new_value != PhenoTipsBot.normalize_value(current_obj.get(key), property_metadata):
+                changes[key] = value
+        return changes
+
+    def normalize_value(value, property_metadata=None):
+        #reduces a value to the form it is compared in, so that e.g. 2015-12-01 equals the 2015-12-01 00:00:00.0 that
+        #the server returns for a date
+        if value == None or value == '':
+            return None
+        value = str(value)
+        property_type = property_metadata.get('type') if property_metadata else None
+        try:
+            if property_type == 'Date':
+                words = value.split()
+                if len(words) == 6:
+                    #the form of java.util.Date.toString, e.g. Tue Dec 01 00:00:00 UTC 2015
+                    return datetime.strptime(words[1] + ' ' + words[2] + ' ' + words[5], '%b %d %Y').strftime('%Y-%m-%d')
+                return datetime.strptime(value[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+            elif property_type == 'Number':
+                return float(value)
+        except ValueError:
+            pass
+        return value
+
+    def pages_query(space, having_object=None):
+        query = ", BaseObject as obj where doc.space = '" + space + "'"
+        if having_object:
+            query += " and doc.fullName = obj.name and obj.className = '" + having_object + "'"
+        return query
+
+    def parse_elements(source, tag):
+        #yields each element with the tag as soon as it is complete, then frees it instead of building the whole tree
+        root = None
+        for event, el in ElementTree.iterparse(source, events=('start', 'end')):
+            if root == None:
+                root = el
+            elif event == 'end' and el.tag == tag:
+                yield el
+                root.clear()
+
+    def parse_properties(object_el):
+        ret = {}
+        for prop in object_el.iter('{http://www.xwiki.org}property'):
+            ret[prop.attrib['name']] = prop.find('{http://www.xwiki.org}value').text
+        return ret
+
+    def patient_query(study=None, owner=None, having_object=None, since=None):
+        query = ", BaseObject as obj"
+        if study != None:
+            query += ", BaseObject as study_obj, StringProperty as study_prop"
+        if owner:
+            query += ", BaseObject as owner_obj, StringProperty as owner_prop"
+        if having_object:
+            query += ", BaseObject as needful_obj"
+        query += " where doc.space = 'data' and doc.fullName = obj.name and obj.className = 'PhenoTips.PatientClass'"
+        if having_object:
+            query += " and doc.fullName = needful_obj.name and needful_obj.className = '" + having_object + "'"
+        if study != None:
+            query += " and doc.fullName = study_obj.name and study_obj.className = 'PhenoTips.StudyBindingClass'"
+            query += " and study_obj.id = study_prop.id.id and study_prop.id.name = 'studyReference'"
+            query += " and study_prop.value = 'xwiki:Studies." + study + "'"
+        if owner:
+            query += " and doc.fullName = owner_obj.name and owner_obj.className = 'PhenoTips.OwnerClass'"
+            query += " and owner_obj.id = owner_prop.id.id and owner_prop.id.name = 'owner'"
+            query += " and owner_prop.value = '" + PhenoTipsBot.qualify(owner) + "'"
+        if since:
+            query += " and doc.date >= " + PhenoTipsBot.quote(since)
+        return query
+
     def qualify(pagename, namespace='XWiki'):
         if not pagename:
             return pagename
@@ -373,12 +895,664 @@ class PhenoTipsBot:
             pagename = 'xwiki:' + pagename
         return pagename
 
+    def quote(value):
+        return "'" + value.replace("'", "''") + "'"
+
+    def result_id(result):
+        #the page name of a search result in either JSON or XML
+        if type(result) == dict:
+            return result['id']
+        return result.find('{http://www.xwiki.org}id').text
+
     def unqualify(pagename, namespace='XWiki'):
         if pagename.startswith('xwiki:' + namespace + '.'):
             return pagename[len('xwiki:') + len(namespace) + len('.'):]
         if pagename.startswith('xwiki:'):
             return pagename[len('xwiki:'):]
 
+class BrowserPool:
+    #the editor has finished loading once its canvas exists and Prototype has no requests outstanding
+    EDITOR_READY_SCRIPT = 'return !!(window.editor && window.Ajax && document.querySelector("#canvas svg") && Ajax.activeRequestCount == 0);'
+    #the save button is re-enabled and the image uploaded once the save engine is idle and the requests have finished
+    SAVE_DONE_SCRIPT = 'return !!(Ajax.activeRequestCount == 0 && !editor.getSaveLoadEngine()._saveInProgress && document.querySelector("#action-save.menu-item"));'
+    #the save engine saves to whichever document XWiki.currentDocument names
+    SWITCH_PATIENT_SCRIPT = 'XWiki.currentDocument = new XWiki.Document(arguments[0], "data");'
+    POLL_INTERVAL = 0.05 #seconds
+
+    def __init__(self, auth, size=PhenoTipsBot.BROWSERS, warm_url=None, timeout=PhenoTipsBot.TIMEOUT):
+        #browsers are started when they are first needed, up to size of them
+        self.auth = auth
+        self.size = size
+        self.warm_url = warm_url
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = queue.Queue()
+        self.n_started = 0
+        self.closed = False
+
+    def acquire(self):
+        with self.lock:
+            if self.closed:
+                raise RuntimeError('The browser pool has been closed')
+            start_browser = self.idle.empty() and self.n_started < self.size
+            if start_browser:
+                self.n_started += 1
+        if start_browser:
+            try:
+                return self.start_browser()
+            except Exception:
+                with self.lock:
+                    self.n_started -= 1
+                raise
+        driver = self.idle.get()
+        if not self.is_healthy(driver):
+            driver = self.restart(driver)
+        return driver
+
+    def close(self):
+        #browsers that are in use are shut down when they are released
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                self.quit(self.idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def is_healthy(self, driver):
+        try:
+            driver.execute_script('return 1;')
+            return True
+        except Exception:
+            return False
+
+    def quit(self, driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass #the browser has already crashed
+
+    def release(self, driver):
+        with self.lock:
+            closed = self.closed
+        if closed:
+            self.quit(driver)
+        else:
+            self.idle.put(driver)
+
+    def restart(self, driver):
+        self.quit(driver)
+        try:
+            return self.start_browser()
+        except Exception:
+            with self.lock:
+                self.n_started -= 1
+            raise
+
+    def run(self, function):
+        #calls the function with a browser from the pool, replacing the browser if it crashed
+        driver = self.acquire()
+        try:
+            ret = function(driver)
+        except Exception:
+            if not self.is_healthy(driver):
+                driver = self.restart(driver)
+            self.release(driver)
+            raise
+        self.release(driver)
+        return ret
+
+    def start(self):
+        #starts the remaining browsers in parallel
+        with self.lock:
+            n_new = self.size - self.n_started
+            self.n_started = self.size
+        if n_new > 0:
+            with ThreadPoolExecutor(n_new) as executor:
+                futures = [executor.submit(self.start_browser) for i in range(n_new)]
+            for future in futures:
+                if future.exception():
+                    with self.lock:
+                        self.n_started -= 1
+                else:
+                    self.release(future.result())
+            for future in futures:
+                if future.exception():
+                    raise future.exception()
+
+    def start_browser(self):
+        authorization = 'Basic ' + b64encode((self.auth[0] + ':' + self.auth[1]).encode('utf-8')).decode('utf-8')
+        capabilities = dict(webdriver.DesiredCapabilities.PHANTOMJS)
+        capabilities['phantomjs.page.customHeaders.authorization'] = authorization
+        driver = webdriver.PhantomJS(desired_capabilities=capabilities)
+        driver.set_window_size(1920, 1080) #big enough to not cut off any elements
+        if self.warm_url:
+            driver.get(self.warm_url) #load the pedigree editor's scripts and styles into the browser's cache
+        return driver
+
+    def wait_for(self, driver, script):
+        #polls a script until it returns true, instead of waiting on elements
+        WebDriverWait(driver, self.timeout, BrowserPool.POLL_INTERVAL).until(lambda driver: driver.execute_script(script))
+
+class CompactRecord(MutableMapping):
+    #a dict-compatible object that keeps its values in one UTF-8 string and decodes each value only when it is read
+    __slots__ = ('layout', 'data', 'ends', 'nones', 'expanded')
+    layouts = {} #property names and their positions, shared by every record with the same properties
+
+    def __init__(self, object_obj=()):
+        object_obj = dict(object_obj)
+        self.expanded = None
+        if not all(value == None or type(value) == str for value in object_obj.values()):
+            self.expanded = object_obj #only strings are packed
+            return
+        names = tuple(object_obj)
+        self.layout = CompactRecord.layouts.get(names)
+        if self.layout == None:
+            names = tuple(map(sys.intern, names))
+            self.layout = (names, {name: i for i, name in enumerate(names)})
+            CompactRecord.layouts[names] = self.layout
+        encoded = [(value or '').encode('utf-8') for value in object_obj.values()]
+        self.data = b''.join(encoded)
+        self.ends = array('I', accumulate(map(len, encoded)))
+        self.nones = sum(1 << i for i, value in enumerate(object_obj.values()) if value == None)
+
+    def __contains__(self, key):
+        if self.expanded != None:
+            return key in self.expanded
+        return key in self.layout[1]
+
+    def __delitem__(self, key):
+        del self.expand()[key]
+
+    def __getitem__(self, key):
+        if self.expanded != None:
+            return self.expanded[key]
+        i = self.layout[1][key]
+        if self.nones >> i & 1:
+            return None
+        return self.data[self.ends[i - 1] if i else 0:self.ends[i]].decode('utf-8')
+
+    def __iter__(self):
+        return iter(self.expanded if self.expanded != None else self.layout[0])
+
+    def __len__(self):
+        return len(self.expanded if self.expanded != None else self.layout[0])
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __setitem__(self, key, value):
+        self.expand()[key] = value
+
+    def copy(self):
+        return CompactRecord(self)
+
+    def expand(self):
+        #a record that is changed becomes an ordinary dict underneath
+        if self.expanded == None:
+            self.expanded = dict(self.items())
+            self.layout = self.data = self.ends = self.nones = None
+        return self.expanded
+
+class ExternalIdIndex:
+    def __init__(self, path, site):
+        self.site = site
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('create table if not exists patients (site text, patient_id text, external_id text, primary key (site, patient_id))')
+        self.db.execute('create index if not exists patients_external_id on patients (site, external_id)')
+        self.db.execute('create table if not exists syncs (site text primary key, synced text)')
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get(self, external_id):
+        with self.lock:
+            rows = self.db.execute('select patient_id from patients where site = ? and external_id = ? order by patient_id',
+                                   (self.site, external_id)).fetchall()
+        if not rows:
+            return None
+        elif len(rows) == 1:
+            return rows[0][0]
+        else:
+            return [row[0] for row in rows]
+
+    def get_synced(self):
+        with self.lock:
+            row = self.db.execute('select synced from syncs where site = ?', (self.site,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, patient_id, external_id):
+        self.put_many([(patient_id, external_id)])
+
+    def put_many(self, pairs):
+        with self.lock:
+            self.db.executemany('insert or replace into patients values (?, ?, ?)',
+                                [(self.site, patient_id, external_id or None) for patient_id, external_id in pairs])
+            self.db.commit()
+
+    def remove(self, patient_id):
+        with self.lock:
+            self.db.execute('delete from patients where site = ? and patient_id = ?', (self.site, patient_id))
+            self.db.commit()
+
+    def retain(self, patient_ids):
+        #forgets the patients that have been deleted from the server
+        patient_ids = set(patient_ids)
+        with self.lock:
+            rows = self.db.execute('select patient_id from patients where site = ?', (self.site,)).fetchall()
+            for row in rows:
+                if row[0] not in patient_ids:
+                    self.db.execute('delete from patients where site = ? and patient_id = ?', (self.site, row[0]))
+            self.db.commit()
+
+    def set_synced(self, synced):
+        with self.lock:
+            self.db.execute('insert or replace into syncs values (?, ?)', (self.site, synced))
+            self.db.commit()
+
+class ImportJournal:
+    BLOCK_SIZE = 1048576 #bytes read at a time by hash_file
+
+    def __init__(self, path):
+        #an append-only log of the work that an import has finished, read back into memory when it is opened
+        self.lock = threading.Lock()
+        self.source = None
+        self.values = {}
+        self.results = {}
+        if os.path.exists(path):
+            length = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    length += len(line)
+                    if entry[0] == 'source':
+                        self.source = entry[1]
+                    elif entry[0] == 'put':
+                        self.values[entry[1]] = entry[2]
+                    elif entry[0] == 'result':
+                        self.results[entry[1]] = entry[2]
+            #drop an entry that was cut off when the import stopped, so that new entries start on a line of their own
+            os.truncate(path, length)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def check_source(self, source):
+        #refuses to resume an import of a different file, whose rows would not line up with the journal
+        with self.lock:
+            if self.source == None:
+                self.source = source
+                self.write(['source', source])
+            elif self.source != source:
+                raise Exception('The journal was written for a different file')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def get(self, key):
+        with self.lock:
+            return self.values.get(key)
+
+    def get_result(self, key):
+        with self.lock:
+            return self.results.get(key)
+
+    def is_empty(self):
+        with self.lock:
+            return self.source == None and not self.values and not self.results
+
+    def put(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.write(['put', key, value])
+
+    def put_result(self, key, result):
+        with self.lock:
+            self.results[key] = result
+            self.write(['result', key, result])
+
+    def write(self, entry):
+        #flushed right away so that nothing is lost if the process is killed
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def hash_file(path):
+        #a fingerprint for check_source, read in blocks so that a large file is never held in memory
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(ImportJournal.BLOCK_SIZE), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+class MetadataCache:
+    TTL = 3600 #seconds
+
+    def __init__(self, path=None, ttl=TTL, ttls=None):
+        #ttls overrides the default time to live of particular keys, e.g. {'pages/XWiki/XWiki.XWikiUsers': 60}
+        self.path = path
+        self.ttl = ttl
+        self.ttls = ttls or {}
+        self.lock = threading.Lock()
+        self.sites = {}
+        if path and os.path.exists(path):
+            with open(path, 'r') as fd:
+                self.sites = json.load(fd, object_pairs_hook=OrderedDict)
+
+    def get(self, site, key):
+        with self.lock:
+            entry = self.sites.get(site, {}).get(key)
+            if not entry or time.time() - entry[0] > self.ttls.get(key, self.ttl):
+                return None
+            return deepcopy(entry[1])
+
+    def invalidate(self, site=None, key=None):
+        with self.lock:
+            if site == None:
+                self.sites = {}
+            elif key == None:
+                self.sites.pop(site, None)
+            else:
+                self.sites.get(site, {}).pop(key, None)
+            self.save()
+
+    def put(self, site, key, value):
+        with self.lock:
+            self.sites.setdefault(site, {})[key] = [time.time(), deepcopy(value)]
+            self.save()
+
+    def save(self):
+        if self.path:
+            with open(self.path + '.tmp', 'w') as fd:
+                json.dump(self.sites, fd)
+            os.replace(self.path + '.tmp', self.path)
+
+class ObjectCache:
+    MAX_ENTRIES = 10000 #objects
+    MAX_AGE = 60 #seconds
+
+    def __init__(self, path=None, max_entries=MAX_ENTRIES, max_age=MAX_AGE):
+        #objects are kept until the page they are on is seen to have a different modification date
+        self.path = path
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() #(patient ID, class, number) -> object, least recently used first
+        self.page_keys = {} #patient ID -> keys of the cached objects on the page
+        self.pages = {} #patient ID -> [modification date, time it was last checked]
+        if path and os.path.exists(path):
+            with open(path, 'r') as fd:
+                data = json.load(fd, object_pairs_hook=OrderedDict)
+            for key, object_obj in data['entries']:
+                self.put(tuple(key), object_obj)
+            for patient_id, modified in data['pages'].items():
+                self.pages[patient_id] = [modified, 0]
+
+    def drop_page(self, patient_id):
+        for key in self.page_keys.pop(patient_id, ()):
+            del self.entries[key]
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return copy(self.entries[key])
+
+    def invalidate(self, patient_id):
+        with self.lock:
+            self.pages.pop(patient_id, None)
+            self.drop_page(patient_id)
+
+    def is_validated(self, patient_id):
+        with self.lock:
+            page = self.pages.get(patient_id)
+            return page != None and time.time() - page[1] < self.max_age
+
+    def put(self, key, object_obj):
+        with self.lock:
+            self.entries[key] = copy(object_obj)
+            self.entries.move_to_end(key)
+            self.page_keys.setdefault(key[0], set()).add(key)
+            while len(self.entries) > self.max_entries:
+                old_key = self.entries.popitem(last=False)[0]
+                self.page_keys[old_key[0]].discard(old_key)
+                if not self.page_keys[old_key[0]]:
+                    del self.page_keys[old_key[0]]
+
+    def save(self):
+        if self.path:
+            with self.lock:
+                data = {'entries': [[list(key), object_obj] for key, object_obj in self.entries.items()],
+                        'pages': {patient_id: page[0] for patient_id, page in self.pages.items()}}
+            with open(self.path + '.tmp', 'w') as fd:
+                json.dump(data, fd)
+            os.replace(self.path + '.tmp', self.path)
+
+    def validate(self, patient_id, modified):
+        #forgets the objects on the page if its modification date changed or it was deleted
+        with self.lock:
+            page = self.pages.get(patient_id)
+            if page == None or page[0] != modified:
+                self.drop_page(patient_id)
+            if modified == None:
+                self.pages.pop(patient_id, None)
+            else:
+                self.pages[patient_id] = [modified, time.time()]
+
+class SiteMirror:
+    SINGLE_CLASSES = ('PhenoTips.PatientClass', 'PhenoTips.StudyBindingClass', 'PhenoTips.OwnerClass')
+    MULTIPLE_CLASSES = ('PhenoTips.RelativeClass', 'PhenoTips.ClinVarVariantClass')
+
+    def __init__(self, path, site):
+        self.site = site
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('create table if not exists pages (site text, patient_id text, modified text, external_id text, primary key (site, patient_id))')
+        self.db.execute('create index if not exists pages_external_id on pages (site, external_id)')
+        self.db.execute('create table if not exists objects (site text, patient_id text, class_name text, object_num integer, properties text,'
+                        ' primary key (site, patient_id, class_name, object_num))')
+        self.db.execute('create index if not exists objects_class_name on objects (site, class_name)')
+        self.db.execute('create table if not exists metadata (site text, key text, value text, primary key (site, key))')
+        self.db.execute('create table if not exists syncs (site text primary key, synced text)')
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def get_all_objects(self, patient_id, classes=None):
+        with self.lock:
+            rows = self.db.execute('select class_name, object_num, properties from objects where site = ? and patient_id = ? order by class_name, object_num',
+                                   (self.site, patient_id)).fetchall()
+        ret = OrderedDict((object_class, OrderedDict()) for object_class in classes or [])
+        for object_class, object_num, properties in rows:
+            if classes == None or object_class in classes:
+                ret.setdefault(object_class, OrderedDict())[str(object_num)] = json.loads(properties)
+        return ret
+
+    def get_bulk(self, patient_ids, object_class):
+        #the first object of the class on each page, like PhenoTipsBot.get_bulk
+        patient_ids = list(patient_ids)
+        found = {}
+        for start in range(0, len(patient_ids), PhenoTipsBot.BULK_CHUNK_SIZE):
+            chunk = patient_ids[start:start + PhenoTipsBot.BULK_CHUNK_SIZE]
+            with self.lock:
+                rows = self.db.execute('select patient_id, properties from objects where site = ? and class_name = ? and patient_id in (' +
+                                       ', '.join('?' * len(chunk)) + ') order by object_num desc', [self.site, object_class] + chunk).fetchall()
+            for patient_id, properties in rows:
+                found[patient_id] = properties
+        ret = OrderedDict()
+        for patient_id in patient_ids:
+            if patient_id in found:
+                ret[patient_id] = json.loads(found[patient_id])
+        return ret
+
+    def get_id(self, external_id):
+        with self.lock:
+            rows = self.db.execute('select patient_id from pages where site = ? and external_id = ? order by patient_id',
+                                   (self.site, external_id)).fetchall()
+        if not rows:
+            return None
+        elif len(rows) == 1:
+            return rows[0][0]
+        else:
+            return [row[0] for row in rows]
+
+    def get_metadata(self, key):
+        with self.lock:
+            row = self.db.execute('select value from metadata where site = ? and key = ?', (self.site, key)).fetchone()
+        return json.loads(row[0], object_pairs_hook=OrderedDict) if row else None
+
+    def get_object(self, patient_id, object_class, object_num):
+        with self.lock:
+            row = self.db.execute('select properties from objects where site = ? and patient_id = ? and class_name = ? and object_num = ?',
+                                  (self.site, patient_id, object_class, int(object_num))).fetchone()
+        if not row:
+            raise KeyError('No ' + object_class + ' ' + str(object_num) + ' on ' + patient_id + ' in the mirror')
+        return json.loads(row[0])
+
+    def get_synced(self):
+        with self.lock:
+            row = self.db.execute('select synced from syncs where site = ?', (self.site,)).fetchone()
+        return row[0] if row else None
+
+    def list(self, study=None, owner=None, having_object=None, since=None):
+        #the same filters as PhenoTipsBot.list, evaluated on the mirrored objects
+        query = 'select patient_id from pages where site = ?'
+        params = [self.site]
+        if since:
+            query += ' and modified >= ?'
+            params.append(since)
+        if having_object:
+            query += ' and patient_id in (select patient_id from objects where site = ? and class_name = ?)'
+            params += [self.site, having_object]
+        if study != None:
+            query += " and patient_id in (select patient_id from objects where site = ? and class_name = 'PhenoTips.StudyBindingClass'"
+            query += " and json_extract(properties, '$.studyReference') = ?)"
+            params += [self.site, 'xwiki:Studies.' + study]
+        if owner:
+            query += " and patient_id in (select patient_id from objects where site = ? and class_name = 'PhenoTips.OwnerClass'"
+            query += " and json_extract(properties, '$.owner') = ?)"
+            params += [self.site, PhenoTipsBot.qualify(owner)]
+        with self.lock:
+            rows = self.db.execute(query + ' order by patient_id', params).fetchall()
+        return [row[0] for row in rows]
+
+    def list_objects(self, patient_id, object_class):
+        with self.lock:
+            rows = self.db.execute('select object_num from objects where site = ? and patient_id = ? and class_name = ? order by object_num',
+                                   (self.site, patient_id, object_class)).fetchall()
+        return [str(row[0]) for row in rows]
+
+    def list_patient_dates(self, since=None, patient_ids=None):
+        with self.lock:
+            rows = self.db.execute('select patient_id, modified from pages where site = ? and modified >= ? order by modified',
+                                   (self.site, since or '')).fetchall()
+        if patient_ids != None:
+            patient_ids = set(patient_ids)
+            rows = [row for row in rows if row[0] in patient_ids]
+        return OrderedDict(rows)
+
+    def put_metadata(self, key, value):
+        with self.lock:
+            self.db.execute('insert or replace into metadata values (?, ?, ?)', (self.site, key, json.dumps(value)))
+            self.db.commit()
+
+    def put_page(self, patient_id, modified, objects):
+        #replaces everything mirrored from the page; objects maps (object_class, object_num) to properties
+        patient_obj = objects.get(('PhenoTips.PatientClass', '0'), {})
+        with self.lock:
+            self.db.execute('delete from objects where site = ? and patient_id = ?', (self.site, patient_id))
+            self.db.executemany('insert into objects values (?, ?, ?, ?, ?)',
+                                [(self.site, patient_id, object_class, int(object_num), json.dumps(object_obj))
+                                 for (object_class, object_num), object_obj in objects.items()])
+            self.db.execute('insert or replace into pages values (?, ?, ?, ?)', (self.site, patient_id, modified, patient_obj.get('external_id') or None))
+            self.db.commit()
+
+    def retain(self, patient_ids):
+        #forgets the patients that have been deleted from the server
+        patient_ids = set(patient_ids)
+        with self.lock:
+            rows = self.db.execute('select patient_id from pages where site = ?', (self.site,)).fetchall()
+            for row in rows:
+                if row[0] not in patient_ids:
+                    self.db.execute('delete from objects where site = ? and patient_id = ?', (self.site, row[0]))
+                    self.db.execute('delete from pages where site = ? and patient_id = ?', (self.site, row[0]))
+            self.db.commit()
+
+    def set_synced(self, synced):
+        with self.lock:
+            self.db.execute('insert or replace into syncs values (?, ?)', (self.site, synced))
+            self.db.commit()
+
+    def sync(self, bot, progress_callback=None):
+        #only the pages modified since the last sync are downloaded again
+        dates = bot.list_patient_dates(self.get_synced())
+        patient_ids = list(dates)
+        count = 0
+        for start in range(0, len(patient_ids), PhenoTipsBot.BULK_CHUNK_SIZE):
+            #each chunk of pages is stored before the next is downloaded, so only one chunk is held at a time and a
+            #failed sync keeps the pages it finished
+            chunk = patient_ids[start:start + PhenoTipsBot.BULK_CHUNK_SIZE]
+            objects = OrderedDict((patient_id, {}) for patient_id in chunk)
+            for object_class in SiteMirror.SINGLE_CLASSES:
+                for patient_id, object_obj in bot.get_bulk(chunk, object_class).items():
+                    objects[patient_id][(object_class, '0')] = object_obj
+
+            #bulk queries find the few pages that have relatives or variants at all
+            having_ids = set()
+            for object_class in SiteMirror.MULTIPLE_CLASSES:
+                having_ids.update(bot.get_bulk(chunk, object_class))
+            for patient_id in chunk:
+                if patient_id in having_ids:
+                    for object_class, object_objs in bot.get_all_objects(patient_id, SiteMirror.MULTIPLE_CLASSES).items():
+                        for object_num, object_obj in object_objs.items():
+                            objects[patient_id][(object_class, object_num)] = object_obj
+
+            for patient_id, page_objects in objects.items():
+                if progress_callback:
+                    progress_callback(count)
+                count += 1
+                self.put_page(patient_id, dates[patient_id], page_objects)
+        self.retain(bot.list())
+
+        for object_class in SiteMirror.SINGLE_CLASSES + SiteMirror.MULTIPLE_CLASSES:
+            self.put_metadata('class_properties/' + object_class, bot.list_class_properties(object_class))
+        for space, having_object in (('Studies', 'PhenoTips.StudyClass'), ('XWiki', 'XWiki.XWikiUsers'), ('Groups', 'PhenoTips.PhenoTipsGroupClass')):
+            self.put_metadata('pages/' + space + '/' + having_object, bot.list_pages(space, having_object))
+
+        #the sync only counts as done once every chunk has been stored
+        if dates:
+            self.set_synced(max(dates.values()))
+        return len(dates)
+
+class StepTimer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = OrderedDict() #step -> [count, total seconds], in the order that the steps first ran
+
+    def reset(self):
+        with self.lock:
+            self.timings.clear()
+
+    def timed(self, step, function, *args):
+        start_time = time.time()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.time() - start_time
+            with self.lock:
+                timing = self.timings.setdefault(step, [0, 0.0])
+                timing[0] += 1
+                timing[1] += elapsed
+
 class ApgarType:
     unknown = 'unknown'
 
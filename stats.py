@@ -22,6 +22,7 @@
 import sys
 from getopt import getopt
 from getpass import getpass
+from phenotipsbot import CompactRecord
 from phenotipsbot import PhenoTipsBot
 from sys import stderr
 
@@ -30,10 +31,11 @@ from sys import stderr
 base_url = None
 username = None
 password = None
+mirror_path = None
 wanted_users = []
 wanted_studies = []
 
-optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'of-user=', 'of-study='])
+optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'mirror=', 'of-user=', 'of-study='])
 for name, value in optlist:
     if name == '--base-url':
         base_url = value
@@ -41,6 +43,8 @@ for name, value in optlist:
         username = value
     elif name == '--password':
         password = value
+    elif name == '--mirror':
+        mirror_path = value
     elif name == '--of-user':
         wanted_users.append(value.lower())
     elif name == '--of-study':
@@ -68,7 +72,7 @@ if not password:
 if not password:
     password = 'admin'
 
-bot = PhenoTipsBot(base_url, username, password)
+bot = PhenoTipsBot(base_url, username, password, mirror_path=mirror_path, record_type=CompactRecord)
 
 patient_ids = bot.list()
 
@@ -82,26 +86,37 @@ negative_phenotype_total = 0
 owners = set()
 studies = set()
 fields_used = set()
-for patient_id in patient_ids:
-    stderr.write(str(count) + '\r')
-    count += 1
+#fetch the objects of one chunk of patients at a time in a few large queries instead of three requests per patient
+for start in range(0, len(patient_ids), bot.BULK_CHUNK_SIZE):
+    chunk = patient_ids[start:start + bot.BULK_CHUNK_SIZE]
+    patients = bot.get_bulk(chunk)
+    owner_objs = bot.get_bulk(chunk, 'PhenoTips.OwnerClass')
+    study_objs = bot.get_bulk(chunk, 'PhenoTips.StudyBindingClass')
 
-    owner = bot.get_owner(patient_id) or ''
-    study = bot.get_study(patient_id) or ''
-    if ((len(wanted_users) == 0 or owner.lower() in wanted_users) and
-            (len(wanted_studies) == 0 or study.lower() in wanted_studies)):
-        patient_total += 1
-        owners.add(owner)
-        studies.add(study)
-        patient = bot.get(patient_id)
-        if patient['phenotype']:
-            positive_phenotype_total += len(patient['phenotype'].split('|'))
-        if patient['negative_phenotype']:
-            negative_phenotype_total += len(patient['negative_phenotype'].split('|'))
-        for key, value in patient.items():
-            if value:
-                #print(key + ': ' + value)
-                fields_used.add(key)
+    for patient_id in chunk:
+        stderr.write(str(count) + '\r')
+        count += 1
+
+        owner = ''
+        if patient_id in owner_objs and owner_objs[patient_id].get('owner'):
+            owner = PhenoTipsBot.unqualify(owner_objs[patient_id]['owner']) or ''
+        study = ''
+        if patient_id in study_objs and study_objs[patient_id].get('studyReference'):
+            study = PhenoTipsBot.unqualify(study_objs[patient_id]['studyReference'], 'Studies') or ''
+        if ((len(wanted_users) == 0 or owner.lower() in wanted_users) and
+                (len(wanted_studies) == 0 or study.lower() in wanted_studies)):
+            patient_total += 1
+            owners.add(owner)
+            studies.add(study)
+            patient = patients[patient_id] if patient_id in patients else bot.get(patient_id)
+            if patient['phenotype']:
+                positive_phenotype_total += len(patient['phenotype'].split('|'))
+            if patient['negative_phenotype']:
+                negative_phenotype_total += len(patient['negative_phenotype'].split('|'))
+            for key, value in patient.items():
+                if value:
+                    #print(key + ': ' + value)
+                    fields_used.add(key)
 
 print('Owned patients: ' + str(patient_total))
 print('Average positive phenotypes per patient: ' + str(positive_phenotype_total / patient_total))
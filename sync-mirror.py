@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#
+# Program for keeping a local copy of a PhenoTips site's patients in sync
+#
+# Copyright 2016 University of Utah
+#
+# This library is free software; you can redistribute it and/or
+# modify it under the terms of the GNU Lesser General Public
+# License as published by the Free Software Foundation; either
+# version 2.1 of the License, or (at your option) any later version.
+#
+# This library is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this library; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301
+# USA
+
+import sys
+import time
+from datetime import timedelta
+from getopt import getopt
+from getpass import getpass
+from phenotipsbot import PhenoTipsBot
+from phenotipsbot import SiteMirror
+from sys import stderr
+
+#parse arguments
+
+base_url = None
+username = None
+password = None
+mirror_path = None
+
+optlist, args = getopt(sys.argv[1:], '', ['base-url=', 'username=', 'password=', 'mirror='])
+for name, value in optlist:
+    if name == '--base-url':
+        base_url = value
+    elif name == '--username':
+        username = value
+    elif name == '--password':
+        password = value
+    elif name == '--mirror':
+        mirror_path = value
+
+if not mirror_path:
+    print('You must specify the mirror file with --mirror.')
+    exit(1)
+
+#get any missing arguments and initialize the bot
+
+if not base_url:
+    sys.stderr.write('Input the URL (blank for http://localhost:8080): ')
+    sys.stderr.flush()
+    base_url = input()
+if not base_url:
+    base_url = 'http://localhost:8080'
+if not base_url.startswith('http://') and not base_url.startswith('https://'):
+    base_url = 'http://' + base_url
+base_url = base_url.rstrip('/')
+
+if not username:
+    username = input('Input your username (blank for Admin): ')
+if not username:
+    username = 'Admin'
+
+if not password:
+    password = getpass('Input your password (blank for admin): ')
+if not password:
+    password = 'admin'
+
+bot = PhenoTipsBot(base_url, username, password)
+mirror = SiteMirror(mirror_path, base_url)
+
+#begin sync
+
+start_time = time.time()
+
+synced = mirror.get_synced()
+if synced:
+    stderr.write('Downloading the patient records modified since ' + synced + '...\n')
+else:
+    stderr.write('Downloading all patient records...\n')
+stderr.write('\n')
+
+n_synced = mirror.sync(bot, lambda count: stderr.write(str(count) + '\r'))
+
+stderr.write('\n')
+stderr.write('Synced ' + str(n_synced) + ' patients.\n')
+stderr.write('Elapsed time ' + str(timedelta(seconds=time.time() - start_time)) + '\n')
+
+mirror.close()
+bot.close()
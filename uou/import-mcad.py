@@ -29,21 +29,24 @@ from getpass import getpass
 from sys import stdout
 
 sys.path.append(os.path.dirname(__file__) + '/..')
+from phenotipsbot import ImportJournal
 from phenotipsbot import PhenoTipsBot
 
 #parse arguments
 
 if len(sys.argv) < 2:
-    print('Syntax: ./import-mcad [--base-url=<value>] [--username=<value>] [--password=<value>] [--study=<value>] [--yes] <file>')
+    print('Syntax: ./import-mcad [--base-url=<value>] [--username=<value>] [--password=<value>] [--study=<value>] [--journal=<file> [--resume]] [--yes] <file>')
     exit(1)
 
 base_url = None
 username = None
 password = None
 study = None
+journal_path = None
+resume = False
 yes = False
 
-optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'yes'])
+optlist, args = getopt(sys.argv[1:], '-y', ['base-url=', 'username=', 'password=', 'study=', 'journal=', 'resume', 'yes'])
 for name, value in optlist:
     if name == '--base-url':
         base_url = value
@@ -53,9 +56,20 @@ for name, value in optlist:
         password = value
     elif name == '--study':
         study = value
+    elif name == '--journal':
+        journal_path = value
+    elif name == '--resume':
+        resume = True
     elif name in ('-y', '--yes'):
         yes = True
 
+if resume and not journal_path:
+    print('You must specify the journal of the import to resume with --journal.')
+    exit(1)
+if journal_path and not resume and os.path.exists(journal_path) and os.path.getsize(journal_path):
+    print('The journal ' + journal_path + ' already exists. Pass --resume to continue the import that it records.')
+    exit(1)
+
 #parse CSV file
 
 reader = csv.reader(open(args[0], 'r', encoding='utf-16'), delimiter='\t')
@@ -167,15 +181,32 @@ if study == None:
 elif study == 'None':
     study = None
 
+#open the journal
+
+journal = None
+if journal_path:
+    journal = ImportJournal(journal_path)
+    journal.check_source(ImportJournal.hash_file(args[0]))
+
 #begin import
 
 if yes or input('You are about to import ' + str(len(patients)) + ' patients. Type y to continue: ')[0] == 'y':
     count = 0
     start_time = time.time()
-    for patient, clinvar_variants in patients:
-        patient_id = bot.create(patient, study)
-        for clinvar_variant in clinvar_variants:
-            bot.create_object(patient_id, 'PhenoTips.ClinVarVariantClass', clinvar_variant)
+    for row_num, (patient, clinvar_variants) in enumerate(patients):
+        #rows and their variants are journaled by position, so a resumed import picks up where the last one stopped
+        key = str(row_num)
+        if not journal or not journal.get_result(key):
+            patient_id = bot.create(patient, study, journal=journal, journal_key=key)
+            for variant_num, clinvar_variant in enumerate(clinvar_variants):
+                variant_key = key + '/' + str(variant_num)
+                if journal and journal.get(variant_key):
+                    continue
+                object_num = bot.create_object(patient_id, 'PhenoTips.ClinVarVariantClass', clinvar_variant)
+                if journal:
+                    journal.put(variant_key, object_num)
+            if journal:
+                journal.put_result(key, 'created')
         count += 1
         stdout.write(str(count) + '\r')
     print()